@@ -1,10 +1,44 @@
 
-from .app import (
-    show,
-    cli
-)
 from . import util
 
+
+def show(debug=False, demo=False, parent=None):
+    """Display Uploader GUI, see `app.show`"""
+    # Qt is imported only when GUI is wanted
+    from . import app
+    return app.show(debug=debug, demo=demo, parent=parent)
+
+
+def cli(args):
+    """Command line entry
+
+    `upload` command runs without GUI, see `headless.cli`, and `bench`
+    tunes a site's transport settings, see `bench.cli`. Otherwise the GUI
+    is launched, arguments are parsed before Qt gets imported.
+
+    """
+    if args and args[0] == "bench":
+        from . import bench
+        return bench.cli(args[1:])
+
+    from .backends import setup_processes
+    setup_processes()
+
+    if args and args[0] == "upload":
+        from . import headless
+        return headless.cli(args[1:])
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--demo", action="store_true")
+
+    args = parser.parse_args(args)
+    demo = args.demo
+
+    show(demo=demo)
+
+
 __all__ = [
     "show",
     "cli",
@@ -1,6 +1,5 @@
 
 import sys
-import argparse
 import logging
 from avalon.vendor.Qt import QtWidgets, QtCore, QtGui
 from avalon.vendor import qtawesome
@@ -210,10 +209,14 @@ def show(debug=False, demo=False, parent=None):
         from . import model, mock
         model._Uploader = mock.MockUploader
         model._PackageProducer = mock.MockPackageProducer
+        model._RemoteManifest = None
+        model._Journal = None
     else:
-        from . import model, worker
+        from . import model, worker, journal
         model._Uploader = worker.Uploader
         model._PackageProducer = worker.PackageProducer
+        model._RemoteManifest = worker.RemoteManifest
+        model._Journal = journal.Journal
 
     with tools.lib.application():
         window = Window(parent)
@@ -221,13 +224,3 @@ def show(debug=False, demo=False, parent=None):
         window.show()
 
         module.window = window
-
-
-def cli(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--demo", action="store_true")
-
-    args = parser.parse_args(args)
-    demo = args.demo
-
-    show(demo=demo)
@@ -0,0 +1,699 @@
+
+import os
+import time
+import types
+import weakref
+import logging
+import threading
+import multiprocessing
+
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue
+
+from . import config, sync
+
+
+main_logger = logging.getLogger("avalon-sftpc")
+
+
+PROCESS = "process"  # One process per connection
+THREAD = "thread"  # One thread per connection, in this process
+ASYNCIO = "asyncio"  # One task per connection, in one event loop thread
+
+BACKENDS = (PROCESS, THREAD, ASYNCIO)
+
+
+def default_backend():
+    """Return how upload workers run, one of `BACKENDS`
+
+    Set by environment variable `AVALON_SFTPC_BACKEND`, defaults to
+    `PROCESS`.
+
+    """
+    return os.getenv("AVALON_SFTPC_BACKEND", PROCESS)
+
+
+def default_start_method():
+    """Return how worker processes are started by standalone app
+
+    Set by environment variable `AVALON_SFTPC_START_METHOD`, defaults to
+    "forkserver" where available, otherwise the platform default.
+
+    """
+    methods = multiprocessing.get_all_start_methods()
+    default = "forkserver" if "forkserver" in methods else methods[0]
+    return os.getenv("AVALON_SFTPC_START_METHOD", default)
+
+
+def setup_processes():
+    """Set how worker processes are started, for standalone app only
+
+    With "forkserver", workers are forked from a server process which has
+    `worker` module, so pysftp and paramiko, imported already. A worker is
+    neither a copy of the app with its GUI and threads (fork), nor a fresh
+    interpreter which imports everything again (spawn). The server is
+    started in background right away, so the first worker doesn't wait.
+
+    Must be called before any multiprocessing object is made. Not for an
+    app embedded in a host, e.g. a DCC, which owns the process.
+
+    """
+    method = default_start_method()
+    try:
+        multiprocessing.set_start_method(method)
+    except (RuntimeError, ValueError) as error:
+        main_logger.debug("Start method '%s' not set: %s" % (method, error))
+        return
+
+    if method != "forkserver":
+        return
+
+    from multiprocessing import forkserver
+    multiprocessing.set_forkserver_preload([__package__ + ".worker"])
+
+    def warm_up():
+        started = time.time()
+        forkserver.ensure_running()
+        main_logger.debug("Fork server ready in %.2fs."
+                          % (time.time() - started))
+
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+def available(name):
+    """Return True if backend's dependencies are installed"""
+    if name == ASYNCIO:
+        try:
+            import asyncssh  # noqa
+        except ImportError:
+            return False
+    return True
+
+
+def get(name):
+    """Return a new backend by name
+
+    Args:
+        name (str): One of `BACKENDS`
+
+    """
+    if name == THREAD:
+        return ThreadBackend()
+    if name == ASYNCIO:
+        return AsyncioBackend()
+    return ProcessBackend()
+
+
+class ProcessBackend(object):
+    """Run each worker in its own process
+
+    Transfers are isolated from each other and from the app, a stuck or
+    crashed worker can be terminated, at the cost of a process per
+    connection.
+
+    """
+
+    name = PROCESS
+
+    def queue(self):
+        """Return a job queue which the workers consume from"""
+        return multiprocessing.Queue()
+
+    def spawn(self, uploader, pipe_in, pipe_out, process_id, throttle=None):
+        """Return a new worker, not yet started
+
+        Args:
+            uploader (type): `Uploader` class
+            pipe_in (queue): Job queue, from `queue()`
+            pipe_out (multiprocessing.Queue): Progress report queue
+            process_id (int): Worker id
+            throttle (throttle.Throttle, optional): Bandwidth limit
+
+        """
+        return uploader(pipe_in, pipe_out, process_id, throttle=throttle)
+
+
+class ThreadBackend(ProcessBackend):
+    """Run each worker in a thread of this process
+
+    Starts in no time and costs a thread stack per connection. SSH crypto
+    and socket I/O release the GIL, but the SFTP protocol handling does
+    not, so workers compete for one core.
+
+    """
+
+    name = THREAD
+
+    def queue(self):
+        return _queue.Queue()
+
+    def spawn(self, uploader, pipe_in, pipe_out, process_id, throttle=None):
+        return ThreadWorker(uploader(pipe_in,
+                                     pipe_out,
+                                     process_id,
+                                     throttle=throttle))
+
+
+class AsyncioBackend(ProcessBackend):
+    """Run each worker as a task in one event loop thread, with `asyncssh`
+
+    The event loop thread is started on first use and shared by all
+    workers of this backend. Requires `asyncssh`.
+
+    """
+
+    name = ASYNCIO
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def loop(self):
+        """Return the event loop, start it if not running"""
+        with self._lock:
+            if self._loop is None:
+                import asyncio
+
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever,
+                                          daemon=True)
+                thread.start()
+
+            return self._loop
+
+    def queue(self):
+        return _AsyncQueue(self.loop())
+
+    def spawn(self, uploader, pipe_in, pipe_out, process_id, throttle=None):
+        return AsyncWorker(self.loop(), uploader(pipe_in,
+                                                 pipe_out,
+                                                 process_id,
+                                                 throttle=throttle))
+
+
+class ThreadWorker(threading.Thread):
+    """Run an `Uploader` in a thread instead of its own process
+
+    Args:
+        uploader (Uploader): Worker to run, never started as a process
+
+    """
+
+    def __init__(self, uploader):
+        super(ThreadWorker, self).__init__()
+        self.uploader = uploader
+        self._id = uploader._id
+
+    @property
+    def consuming(self):
+        return self.uploader.consuming
+
+    def stop(self, abort=False):
+        self.uploader.stop(abort=abort)
+
+    def retire(self):
+        self.uploader.retire()
+
+    def terminate(self):
+        # A thread cannot be killed, the best we can do is interrupting its
+        # transfer and leaving it to die with the app as a daemon.
+        self.uploader.stop(abort=True)
+
+    def run(self):
+        self.uploader.run()
+
+
+class _AsyncQueue(object):
+    """Job queue which is put from any thread and got in the event loop"""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = None  # Made in the loop, on first use
+
+    def put(self, item):
+        self._loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        self._get_queue().put_nowait(item)
+
+    def _get_queue(self):
+        if self._queue is None:
+            import asyncio
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def get_nowait(self):
+        return self._get_queue().get_nowait()
+
+    def get(self):
+        return self._get_queue().get()
+
+
+class AsyncWorker(object):
+    """Run an `Uploader`'s jobs as a task in event loop, with `asyncssh`
+
+    The uploader holds the worker's state, its events, throttle and
+    progress reporter, the transfers are done here. Each file is written
+    with up to `MAX_REQUESTS` write requests in flight, files of a batch
+    are uploaded concurrently through the same SFTP session.
+
+    Files are never uploaded in segments, a big file goes through one
+    connection, see `SiteConfig.segments`.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): Event loop to run in
+        uploader (Uploader): Worker state, never started as a process
+
+    """
+
+    MAX_REQUESTS = 64
+    IDLE_TIMEOUT = 300
+    READ_SIZE = 1024**2  # Bytes read from local file at a time
+
+    def __init__(self, loop, uploader):
+        self.loop = loop
+        self.uploader = uploader
+        self.daemon = True  # For interface, dies with the app anyway
+        self._id = uploader._id
+        self._future = None
+        self._done = threading.Event()
+        # site name: [connection, sftp, last used, site config, known dirs]
+        self._sessions = dict()
+        self._connecting = None
+        self._no_exec = weakref.WeakSet()  # Connections that can't exec
+
+    @property
+    def consuming(self):
+        return self.uploader.consuming
+
+    def stop(self, abort=False):
+        self.uploader.stop(abort=abort)
+
+    def retire(self):
+        self.uploader.retire()
+
+    def start(self):
+        import asyncio
+        self._future = asyncio.run_coroutine_threadsafe(self._run(),
+                                                        self.loop)
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def is_alive(self):
+        return self._future is not None and not self._done.is_set()
+
+    def terminate(self):
+        if self._future is not None:
+            self._future.cancel()
+
+    async def _run(self):
+        import asyncio
+        from .worker import _STOP, ProgressReporter
+
+        uploader = self.uploader
+        uploader.reporter = ProgressReporter(uploader.pipe_out, uploader._id)
+        pipe_in = uploader.pipe_in
+        self._connecting = asyncio.Lock()
+
+        try:
+            while not uploader.retired.is_set():
+                try:
+                    job = pipe_in.get_nowait()
+                except asyncio.QueueEmpty:
+                    # Running out of jobs, deliver what we have done
+                    uploader.reporter.flush()
+                    try:
+                        job = await asyncio.wait_for(pipe_in.get(),
+                                                     uploader.POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        self._prune()
+                        continue
+
+                if job == _STOP:
+                    break
+
+                uploader.busy.set()
+                try:
+                    jobs = job if isinstance(job, list) else [job]
+                    await asyncio.gather(*[self._process(job, len(jobs) > 1)
+                                           for job in jobs])
+                finally:
+                    uploader.busy.clear()
+        finally:
+            uploader.reporter.flush()
+            for site in list(self._sessions):
+                self._discard(site)
+            self._done.set()
+
+    async def _process(self, job, batched=False):
+        from .worker import Aborted
+
+        src, dst, fsize = job.content
+        reporter = self.uploader.reporter
+
+        try:
+            site_config = config.registry.get(job.site)
+        except Exception as error:
+            reporter.finish(job._id, fsize, error)
+            return
+
+        # Retry once on a fresh connection if the pooled one was broken
+        # in the middle of the transfer
+        for retry in (False, True):
+            try:
+                session = await self._acquire(site_config)
+            except Exception as error:
+                reporter.finish(job._id, fsize, error)
+                return
+
+            try:
+                await self._upload(session, job, site_config, batched)
+            except Exception as error:
+                if (not retry and not isinstance(error, Aborted) and
+                        session[0].is_closed()):
+                    self._discard(job.site, session)
+                    continue
+                reporter.finish(job._id, fsize, error)
+            else:
+                reporter.finish(job._id, fsize, 1)
+            return
+
+    async def _acquire(self, site_config):
+        """Return the site's session, connect if needed
+
+        Concurrent jobs of a batch wait for the same connection.
+
+        """
+        import asyncssh
+
+        site = site_config.name
+        async with self._connecting:
+            session = self._sessions.get(site)
+            if session is not None:
+                if session[3] is site_config and not session[0].is_closed():
+                    session[2] = time.time()
+                    return session
+                self._discard(site)
+
+            options = dict(port=site_config.port,
+                           username=site_config.username,
+                           password=site_config.password)
+            if site_config.password is not None:
+                options["client_keys"] = None  # Same as `worker.connect`
+            if site_config.hostkey is not None:
+                key = asyncssh.import_public_key(
+                    "ssh-rsa " + site_config.hostkey.get_base64())
+                options["known_hosts"] = ([key], [], [])
+            if site_config.window_size:
+                options["window"] = site_config.window_size
+            if site_config.max_packet_size:
+                options["max_pktsize"] = site_config.max_packet_size
+            if site_config.ciphers:
+                options["encryption_algs"] = list(site_config.ciphers)
+            options["compression_algs"] = (
+                ["zlib@openssh.com", "zlib"] if site_config.compression
+                else ["none"])
+
+            conn = await asyncssh.connect(site_config.host, **options)
+            try:
+                sftp = await conn.start_sftp_client()
+            except Exception:
+                conn.close()
+                raise
+
+            session = [conn, sftp, time.time(), site_config, set()]
+            self._sessions[site] = session
+
+            return session
+
+    def _discard(self, site, session=None):
+        """Close the site's session, if it's still the given one"""
+        current = self._sessions.get(site)
+        if current is None or (session is not None and current is not session):
+            return
+        del self._sessions[site]
+        current[0].close()
+
+    def _prune(self):
+        now = time.time()
+        for site, session in list(self._sessions.items()):
+            if now - session[2] > self.IDLE_TIMEOUT:
+                self._discard(site)
+
+    async def _upload(self, session, job, site_config, batched=False):
+        """Upload one job's file, or skip if exists"""
+        import asyncssh
+        from .worker import PART_SUFFIX
+
+        conn, sftp, _, _, known_dirs = session
+        src, dst, fsize = job.content
+
+        if job.skip_exists:
+            try:
+                attrs = await sftp.stat(dst)
+            except asyncssh.SFTPNoSuchFile:
+                pass  # Not exists, do upload!
+            else:
+                stat = types.SimpleNamespace(st_size=attrs.size,
+                                             st_mtime=attrs.mtime)
+                synced = await self._io(sync.compare,
+                                        site_config.sync, src, fsize, stat)
+                if synced is None:
+                    synced = await self._verify(conn, sftp, src, dst,
+                                                fsize)
+                if synced:
+                    return
+
+        remote_dir = os.path.dirname(dst)
+        if remote_dir and remote_dir not in known_dirs:
+            await sftp.makedirs(remote_dir, exist_ok=True)
+            known_dirs.add(remote_dir)
+
+        if batched:
+            await self._put_small(sftp, job, site_config)
+            return
+
+        # Partial file is left for resuming if aborted
+        part = dst + PART_SUFFIX
+        await self._put(sftp, job, part, site_config)
+        await self._complete(sftp, src, part, dst, fsize)
+
+    async def _verify(self, conn, sftp, src, dst, fsize):
+        """Async version of `sync.verify`, with `md5sum` on server
+
+        Not synced if the server doesn't run it, see `sync.remote_digest`.
+
+        """
+        import asyncssh
+        from shlex import quote
+
+        if conn in self._no_exec:
+            return False
+
+        try:
+            result = await conn.run("md5sum " + quote(dst),
+                                    check=False,
+                                    stdin=asyncssh.DEVNULL,
+                                    timeout=(sync.EXEC_TIMEOUT +
+                                             fsize / sync.HASH_RATE))
+        except (asyncssh.Error, OSError):
+            self._no_exec.add(conn)
+            return False
+
+        if result.exit_status != 0:
+            return False
+
+        local = await self._io(sync.cache.digest, src)
+        if sync.parse_md5sum(result.stdout) != local:
+            return False
+
+        stat = await self._io(os.stat, src)
+        await sftp.utime(dst, (stat.st_atime, stat.st_mtime))
+        return True
+
+    async def _io(self, func, *args):
+        """Run blocking local file I/O in executor, so a slow read (e.g. on
+        NFS) doesn't stall the other workers on the loop
+        """
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def _put(self, sftp, job, part, site_config):
+        """Write file into partial file with pipelined requests, resume if
+        possible, see `Uploader._put`
+        """
+        import asyncio
+        from .worker import Aborted
+
+        src, dst, fsize = job.content
+        uploader = self.uploader
+        reporter = uploader.reporter
+        chunk_size = site_config.chunk_size
+        max_requests = self.MAX_REQUESTS if site_config.pipelined else 1
+        # Read in blocks of whole chunks, fewer trips to the executor
+        read_size = max(1, self.READ_SIZE // chunk_size) * chunk_size
+
+        offset = await self._resume_offset(sftp, src, part, fsize)
+        if offset:
+            main_logger.debug("Resuming '%s' from %d." % (dst, offset))
+
+        local = await self._io(open, src, "rb", site_config.buffer_size)
+        pending = dict()  # write request: size
+        try:
+            async with sftp.open(part, "r+b" if offset else "wb") as remote:
+                try:
+                    await self._io(local.seek, offset)
+                    position = offset
+                    reporter.progress(job._id, position)
+
+                    while True:
+                        block = await self._io(local.read, read_size)
+                        if not block:
+                            break
+
+                        for start in range(0, len(block), chunk_size):
+                            data = block[start:start + chunk_size]
+                            if uploader.aborted.is_set():
+                                raise Aborted("Upload aborted.")
+
+                            delay = uploader.throttle.delay(len(data))
+                            if delay > 0:
+                                await asyncio.sleep(delay)
+
+                            request = asyncio.ensure_future(
+                                remote.write(data, position))
+                            pending[request] = len(data)
+                            position += len(data)
+
+                            if len(pending) >= max_requests:
+                                done, _ = await asyncio.wait(
+                                    pending,
+                                    return_when=asyncio.FIRST_COMPLETED)
+                                for request in done:
+                                    del pending[request]
+                                    request.result()  # Raise write error
+                                reporter.progress(
+                                    job._id,
+                                    position - sum(pending.values()))
+
+                    for request in list(pending):
+                        await request
+                        del pending[request]
+                    reporter.progress(job._id, position)
+
+                finally:
+                    for request in pending:
+                        request.cancel()
+        finally:
+            local.close()
+
+    async def _put_small(self, sftp, job, site_config):
+        """Write a small file of a batch with all requests at once, same as
+        `Uploader._upload_batch`
+
+        The partial file is renamed to destination once completed, or
+        removed if failed.
+
+        """
+        import asyncio
+        import asyncssh
+        from .worker import Aborted, PART_SUFFIX
+
+        src, dst, fsize = job.content
+        uploader = self.uploader
+        chunk_size = site_config.chunk_size
+
+        if uploader.aborted.is_set():
+            raise Aborted("Upload aborted.")
+
+        data, stat = await self._io(_read_file, src)
+
+        delay = uploader.throttle.delay(len(data))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        part = dst + PART_SUFFIX
+        try:
+            if len(data) != fsize:
+                raise IOError("Size mismatch in upload! %d != %d"
+                              % (len(data), fsize))
+
+            async with sftp.open(part, "wb") as remote:
+                await asyncio.gather(*[
+                    remote.write(data[i:i + chunk_size], i)
+                    for i in range(0, len(data), chunk_size)
+                ])
+                await remote.utime((stat.st_atime, stat.st_mtime))
+
+        except Exception:
+            try:
+                await sftp.remove(part)
+            except (asyncssh.Error, OSError):
+                pass
+            raise
+
+        await self._rename(sftp, part, dst)
+
+    async def _resume_offset(self, sftp, src, part, fsize):
+        """Async version of `worker._resume_offset`"""
+        import asyncssh
+        from .worker import RESUME_WINDOW
+
+        try:
+            size = (await sftp.stat(part)).size
+        except asyncssh.SFTPError:
+            return 0
+
+        if not size or size > fsize:
+            return 0
+
+        window = min(RESUME_WINDOW, size)
+        try:
+            async with sftp.open(part, "rb") as remote:
+                tail = await remote.read(window, size - window)
+        except asyncssh.SFTPError:
+            return 0
+
+        if tail != await self._io(_read_at, src, size - window, window):
+            return 0
+
+        return size
+
+    async def _complete(self, sftp, src, part, dst, fsize):
+        """Async version of `worker._complete`"""
+        size = (await sftp.stat(part)).size
+        if size != fsize:
+            raise IOError("Size mismatch in upload! %d != %d" % (size, fsize))
+
+        local_stat = await self._io(os.stat, src)
+        await sftp.utime(part, (local_stat.st_atime, local_stat.st_mtime))
+        await self._rename(sftp, part, dst)
+
+    async def _rename(self, sftp, part, dst):
+        """Rename completed partial file to destination"""
+        import asyncssh
+
+        try:
+            # Atomic overwrite, OpenSSH extension
+            await sftp.posix_rename(part, dst)
+        except asyncssh.SFTPError:
+            try:
+                await sftp.remove(dst)
+            except asyncssh.SFTPError:
+                pass
+            await sftp.rename(part, dst)
+
+
+def _read_file(path):
+    """Return whole content and stat of a local file"""
+    with open(path, "rb") as file:
+        return file.read(), os.fstat(file.fileno())
+
+
+def _read_at(path, offset, size):
+    """Return `size` bytes of a local file from `offset`"""
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return file.read(size)
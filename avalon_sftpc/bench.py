@@ -0,0 +1,320 @@
+
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+
+
+main_logger = logging.getLogger("avalon-sftpc")
+
+
+# Settings to try and their candidate values, in the order they are swept
+SWEEP = collections.OrderedDict([
+    ("pipelined", [True, False]),
+    ("chunk_size", [32768, 65536, 131072, 261120]),
+    ("window_size", [None, 1024**2 * 8, 1024**2 * 32, 1024**2 * 128]),
+    ("max_packet_size", [None, 65536, 262144]),
+    ("buffer_size", [-1, 1024**2, 1024**2 * 4]),
+    ("ciphers", [None,
+                 ("aes128-ctr",),
+                 ("aes256-ctr",),
+                 ("aes128-cbc",)]),
+    ("compression", [False, True]),
+])
+
+SLOW_FACTOR = 3  # A trial slower than the best by this is stopped early
+
+
+class TooSlow(Exception):
+    """Trial stopped early, it can't beat the best one"""
+
+
+class DelayProxy(object):
+    """Forward TCP connections to `target` with added latency
+
+    Data is delayed by half of `latency` in each direction, so a round
+    trip through the proxy takes `latency` longer. It's a userspace stand
+    in for `tc qdisc ... netem delay`, for links between far studios.
+
+    Args:
+        target (tuple): Host and port to forward to
+        latency (float): Round trip time to add, in seconds
+
+    """
+
+    def __init__(self, target, latency):
+        self.target = target
+        self.delay = latency / 2.0
+        self._server = None
+        self._closed = False
+
+    @property
+    def address(self):
+        return self._server.getsockname()
+
+    def start(self):
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", 0))
+        server.listen(16)
+        self._server = server
+
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._closed = True
+        self._server.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                client, _ = self._server.accept()
+                upstream = socket.create_connection(self.target)
+            except OSError:
+                continue
+
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._pump(client, upstream)
+            self._pump(upstream, client)
+
+    def _pump(self, src, dst):
+        """Read from `src` as fast as possible, send to `dst` when due"""
+        pending = collections.deque()  # (due time, data)
+        arrived = threading.Condition()
+
+        def read():
+            while True:
+                try:
+                    data = src.recv(65536)
+                except OSError:
+                    data = b""
+                with arrived:
+                    pending.append((time.time() + self.delay, data))
+                    arrived.notify()
+                if not data:
+                    return
+
+        def write():
+            while True:
+                with arrived:
+                    while not pending:
+                        arrived.wait()
+                    due, data = pending.popleft()
+
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        for target in (read, write):
+            threading.Thread(target=target, daemon=True).start()
+
+
+def measure(site_config, src, dst, deadline=None):
+    """Upload `src` to `dst` once with `site_config`, return MB/s
+
+    The file goes through the same code as workers upload a single file
+    with, see `worker.Uploader._put`.
+
+    Args:
+        site_config (SiteConfig): Site settings to try
+        src (str): Local file path
+        dst (str): Remote file path
+        deadline (float, optional): Seconds before giving up
+
+    Raises:
+        TooSlow: If not done before `deadline`
+
+    """
+    from .worker import Uploader, connect
+    from .pool import JobItem
+
+    fsize = os.path.getsize(src)
+    job = JobItem(0, site_config.name, (src, dst, fsize))
+    uploader = Uploader(None, None, 0)  # Never started, just for `_put`
+
+    conn = connect(site_config)
+    try:
+        started = time.time()
+
+        def callback(transferred, to_be_transferred):
+            if deadline and time.time() - started > deadline:
+                raise TooSlow()
+
+        uploader._put(conn, job, callback, site_config)
+        elapsed = time.time() - started
+
+        conn.sftp_client.remove(dst)
+    finally:
+        try:
+            conn.sftp_client.remove(dst + ".part")
+        except IOError:
+            pass
+        conn.close()
+
+    return fsize / elapsed / 1024**2
+
+
+def sweep(site_config, remote_dir, size, repeat=1, stream=None):
+    """Try settings one at a time, keep the best value of each
+
+    Args:
+        site_config (SiteConfig): Site settings to start from
+        remote_dir (str): Remote dir to upload test file into
+        size (int): Test file size in bytes
+        repeat (int, optional): Uploads per trial, the fastest counts
+        stream (file, optional): Where to print trials, defaults to stdout
+
+    Returns:
+        tuple: Best `SiteConfig`, its MB/s and the starting one's MB/s
+
+    """
+    stream = stream or sys.stdout
+
+    with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as file:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, 1024**2))
+            file.write(block)
+            remaining -= len(block)
+        src = file.name
+
+    dst = remote_dir.rstrip("/") + "/" + os.path.basename(src)
+
+    def trial(candidate, best_speed):
+        deadline = None
+        if best_speed:
+            deadline = size / (best_speed * 1024**2) * SLOW_FACTOR
+
+        speeds = list()
+        for _ in range(repeat):
+            try:
+                speeds.append(measure(candidate, src, dst, deadline))
+            except TooSlow:
+                return 0
+        return max(speeds)
+
+    try:
+        best = site_config
+        baseline = best_speed = trial(best, 0)
+        stream.write("baseline: %.2f MB/s\n" % baseline)
+
+        for key, values in SWEEP.items():
+            for value in values:
+                if value == getattr(best, key):
+                    continue
+
+                candidate = best._replace(**{key: value})
+                try:
+                    speed = trial(candidate, best_speed)
+                except Exception as error:
+                    stream.write("  %s=%s: failed, %s\n"
+                                 % (key, _format(value), error))
+                    continue
+
+                stream.write("  %s=%s: %s\n"
+                             % (key,
+                                _format(value),
+                                "%.2f MB/s" % speed if speed else "too slow"))
+                if speed > best_speed:
+                    best, best_speed = candidate, speed
+
+    finally:
+        os.remove(src)
+
+    return best, best_speed, baseline
+
+
+def _format(value):
+    if value is None:
+        return "default"
+    if isinstance(value, tuple):
+        return ",".join(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def cli(args):
+    parser = argparse.ArgumentParser(
+        prog="python -m avalon_sftpc bench",
+        description="Find the fastest transport settings of a site, by "
+                    "uploading a test file with one setting changed at a "
+                    "time.")
+    parser.add_argument("site",
+                        help="Site name, a `.cfg` in AVALON_SFTPC_SITES")
+    parser.add_argument("remote_dir",
+                        help="Remote dir to upload the test file into")
+    parser.add_argument("--size", type=int, default=16,
+                        help="Test file size in MB, default 16")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Round trip time in ms to add with a local "
+                             "delay proxy, e.g. 150 to simulate a far "
+                             "studio from a server nearby")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Uploads per trial, the fastest counts")
+
+    args = parser.parse_args(args)
+
+    if not main_logger.handlers:
+        main_logger.addHandler(logging.StreamHandler())
+
+    from .config import registry
+
+    try:
+        site_config = registry.get(args.site)
+    except Exception as error:
+        main_logger.error(str(error))
+        return 1
+
+    proxy = None
+    if args.latency:
+        proxy = DelayProxy((site_config.host, site_config.port),
+                           args.latency / 1000.0)
+        proxy.start()
+        host, port = proxy.address
+        # Host key is still checked against the site's `hostkey`
+        site_config = site_config._replace(host=host, port=port)
+        print("Through delay proxy %s:%d, +%dms round trip"
+              % (host, port, args.latency))
+
+    try:
+        best, speed, baseline = sweep(site_config,
+                                      args.remote_dir,
+                                      args.size * 1024**2,
+                                      repeat=args.repeat)
+    except Exception as error:
+        main_logger.error("Benchmark failed: %s" % error)
+        return 1
+    finally:
+        if proxy is not None:
+            proxy.stop()
+
+    print("\nBest: %.2f MB/s, baseline %.2f MB/s" % (speed, baseline))
+
+    changed = [key for key in SWEEP
+               if getattr(best, key) != getattr(site_config, key)]
+    if changed:
+        print("Add to '%s.cfg':" % args.site)
+        for key in changed:
+            value = getattr(best, key)
+            print("%s=%s" % (key, "" if value is None else _format(value)))
+    else:
+        print("Current settings are the best.")
+
+    return 0
@@ -0,0 +1,274 @@
+
+import os
+import time
+import base64
+import threading
+import collections
+
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
+from . import backends, sync, throttle
+
+
+SECTION = "avalon-sftp"
+
+CHUNK_SIZE = 32768  # Same as `paramiko.SFTPFile.MAX_REQUEST_SIZE`
+MAX_CHUNK_SIZE = 261120  # Largest write OpenSSH server accepts
+
+
+SiteConfig = collections.namedtuple("SiteConfig", [
+    "name",
+    "host",
+    "port",
+    "username",
+    "password",
+    "hostkey",  # Decoded `paramiko.RSAKey`, or None
+    "workers",
+    "adaptive",
+    "min_workers",
+    "max_workers",
+    "batch_size",
+    "small_file",
+    "segments",
+    "segment_threshold",
+    "sync",  # Policy of skipping existing files, see `sync.MODES`
+    "bandwidth",  # `throttle.Schedule` of this site's uploads
+    "backend",  # How workers run, see `backends.BACKENDS`
+    # Transport tuning, see `bench`
+    "window_size",  # SSH channel window in bytes, None for default
+    "max_packet_size",  # SSH channel max packet in bytes, None for default
+    "pipelined",  # Send writes without waiting for each reply
+    "chunk_size",  # Bytes per SFTP write request
+    "buffer_size",  # Local file read buffer in bytes, -1 for default
+    "ciphers",  # Tuple of preferred ciphers, None for default
+    "compression",  # Whether to compress SSH traffic
+])
+
+
+def _getenv_int(key, default):
+    value = os.getenv(key)
+    return int(value) if value else default
+
+
+def _to_bool(value):
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def default_workers():
+    """Return global number of upload workers per site
+
+    Set by environment variable `AVALON_SFTPC_WORKERS`, defaults to 10.
+
+    """
+    return _getenv_int("AVALON_SFTPC_WORKERS", 10)
+
+
+def default_adaptive():
+    """Return whether to auto-scale workers by default
+
+    Set by environment variable `AVALON_SFTPC_ADAPTIVE`, defaults to False.
+
+    """
+    return _to_bool(os.getenv("AVALON_SFTPC_ADAPTIVE", ""))
+
+
+def default_max_workers():
+    """Return global upper bound of auto-scaled workers per site
+
+    Set by environment variable `AVALON_SFTPC_MAX_WORKERS`, defaults to 32.
+
+    """
+    return _getenv_int("AVALON_SFTPC_MAX_WORKERS", 32)
+
+
+def default_idle_timeout():
+    """Return seconds a site's workers may sit idle before they exit
+
+    They are started again on next job of the site. Set by environment
+    variable `AVALON_SFTPC_IDLE_TIMEOUT`, defaults to 300, 0 keeps them
+    forever.
+
+    """
+    return _getenv_int("AVALON_SFTPC_IDLE_TIMEOUT", 300)
+
+
+def sites_root():
+    """Return the dir path which contains sites' config files"""
+    default_sites = os.path.dirname(__file__) + "/sites"
+    return os.getenv("AVALON_SFTPC_SITES", default_sites)
+
+
+def parse_site(site_name, site_cfg):
+    """Read site settings from a configuration file
+
+    Args:
+        site_name (str): Site name
+        site_cfg (str): Path to site's `.cfg` file
+
+    Returns:
+        SiteConfig
+
+    """
+    parser = ConfigParser()
+    parser.read(site_cfg)
+    get = (lambda key: parser.get(SECTION, key, fallback=""))
+
+    hostkey = b"".join(get("hostkey").encode().split())
+    if hostkey:
+        import paramiko
+        hostkey = paramiko.RSAKey(data=base64.decodebytes(hostkey))
+    else:
+        hostkey = None
+
+    workers = int(get("workers") or default_workers())
+    adaptive = get("adaptive")
+    adaptive = _to_bool(adaptive) if adaptive else default_adaptive()
+    min_workers = int(get("min_workers") or 1)
+    max_workers = int(get("max_workers") or default_max_workers())
+    # Bounds should always embrace the initial count
+    min_workers = max(1, min(min_workers, workers))
+    max_workers = max(max_workers, workers)
+
+    # Files not bigger than `small_file` (bytes) are uploaded in batches
+    batch_size = int(get("batch_size") or 32)
+    small_file = int(get("small_file") or 1024**2)
+
+    # Files not smaller than `segment_threshold` (bytes) are uploaded in
+    # `segments` byte ranges concurrently
+    segments = int(get("segments") or 4)
+    segment_threshold = int(get("segment_threshold") or 1024**3)
+
+    sync_mode = get("sync") or sync.default_mode()
+    if sync_mode not in sync.MODES:
+        raise Exception("Site '%s' has unknown sync mode: %s"
+                        "" % (site_name, sync_mode))
+
+    try:
+        bandwidth = throttle.Schedule(get("bandwidth"))
+    except ValueError as error:
+        raise Exception("Site '%s' has invalid bandwidth: %s"
+                        "" % (site_name, error))
+
+    backend = get("backend") or backends.default_backend()
+    if backend not in backends.BACKENDS:
+        raise Exception("Site '%s' has unknown backend: %s"
+                        "" % (site_name, backend))
+
+    window_size = int(get("window_size") or 0) or None
+    max_packet_size = int(get("max_packet_size") or 0) or None
+    pipelined = get("pipelined")
+    pipelined = _to_bool(pipelined) if pipelined else True
+    buffer_size = int(get("buffer_size") or -1)
+    ciphers = tuple(cipher.strip()
+                    for cipher in (get("ciphers") or "").split(",")
+                    if cipher.strip()) or None
+    compression = _to_bool(get("compression") or "")
+
+    chunk_size = int(get("chunk_size") or CHUNK_SIZE)
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise Exception("Site '%s' has invalid chunk_size: %d, should be "
+                        "within 1 to %d" % (site_name,
+                                            chunk_size,
+                                            MAX_CHUNK_SIZE))
+
+    return SiteConfig(
+        name=site_name,
+        host=get("host"),
+        port=int(get("port") or 22),
+        username=get("username"),
+        password=get("password"),
+        hostkey=hostkey,
+        workers=workers,
+        adaptive=adaptive,
+        min_workers=min_workers,
+        max_workers=max_workers,
+        batch_size=batch_size,
+        small_file=small_file,
+        segments=segments,
+        segment_threshold=segment_threshold,
+        sync=sync_mode,
+        bandwidth=bandwidth,
+        backend=backend,
+        window_size=window_size,
+        max_packet_size=max_packet_size,
+        pipelined=pipelined,
+        chunk_size=chunk_size,
+        buffer_size=buffer_size,
+        ciphers=ciphers,
+        compression=compression,
+    )
+
+
+class SiteRegistry(object):
+    """Process-wide cache of parsed site configurations
+
+    Each site's `.cfg` file is parsed once and re-parsed only when its
+    modification time or size has changed. The file is not even stat'ed
+    again within `CHECK_INTERVAL` seconds, so looking up the same site for
+    every job costs nothing on a network-mounted sites directory.
+
+    Args:
+        root (str, optional): Sites dir, defaults to `sites_root()`
+
+    """
+
+    CHECK_INTERVAL = 5
+
+    def __init__(self, root=None):
+        self._root = root
+        self._sites = dict()  # site_cfg: [signature, last check, config]
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return self._root or sites_root()
+
+    def get(self, site_name):
+        """Return site configuration
+
+        Args:
+            site_name (str): Site name
+
+        Returns:
+            SiteConfig
+
+        """
+        site_cfg = self.root + "/%s.cfg" % site_name
+        now = time.time()
+
+        with self._lock:
+            cached = self._sites.get(site_cfg)
+            if cached is not None and now - cached[1] < self.CHECK_INTERVAL:
+                return cached[2]
+
+        try:
+            stat = os.stat(site_cfg)
+        except OSError:
+            raise Exception("Site '%s' configuration file not found: %s"
+                            "" % (site_name, site_cfg))
+
+        signature = (stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            cached = self._sites.get(site_cfg)
+            if cached is not None and cached[0] == signature:
+                cached[1] = now
+                return cached[2]
+
+        config = parse_site(site_name, site_cfg)
+
+        with self._lock:
+            self._sites[site_cfg] = [signature, now, config]
+
+        return config
+
+    def flush(self):
+        """Forget all cached configurations"""
+        with self._lock:
+            self._sites.clear()
+
+
+registry = SiteRegistry()
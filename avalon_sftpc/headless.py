@@ -0,0 +1,304 @@
+
+import sys
+import time
+import logging
+import argparse
+import itertools
+import threading
+from multiprocessing import Queue
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from .pool import WorkerPool, JobItem
+from .throttle import Schedule
+
+
+main_logger = logging.getLogger("avalon-sftpc")
+
+
+class _ErrorCounter(logging.Handler):
+    """Count error logs, e.g. job file parsing errors while staging"""
+
+    def __init__(self):
+        super(_ErrorCounter, self).__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Session(object):
+    """Upload job file's packages without GUI
+
+    Packages are queued as soon as they are produced, so uploading starts
+    before the whole job file is parsed. Progress is printed every
+    `interval` seconds, in place if the output is a terminal.
+
+    Args:
+        uploader (type): `Uploader` class to spawn
+        producer (type): `PackageProducer` class
+        manifest (type, optional): `RemoteManifest` class
+        workers (int, optional): Number of workers per site, overrides
+            site's `.cfg`
+        bandwidth (str, optional): Total bandwidth `throttle.Schedule` of
+            all sites, overrides `AVALON_SFTPC_BANDWIDTH`
+        skip_exists (bool, optional): Skip files which already exist and in
+            sync on remote, see `sync`
+        interval (float, optional): Seconds between progress output
+        stream (file, optional): Progress output, defaults to `sys.stderr`
+
+    """
+
+    def __init__(self,
+                 uploader,
+                 producer,
+                 manifest=None,
+                 workers=None,
+                 bandwidth=None,
+                 skip_exists=False,
+                 interval=1.0,
+                 stream=None):
+
+        self.pipe_out = Queue()
+        self.producer = producer()
+        self.consumers = WorkerPool(uploader,
+                                    self.pipe_out,
+                                    manifest=manifest,
+                                    workers=workers,
+                                    bandwidth=bandwidth)
+        self.skip_exists = skip_exists
+        self.interval = interval
+        self.stream = stream or sys.stderr
+
+        self.jobs = dict()  # job id: job
+        self.hashes = set()
+        self.total_bytes = 0
+        self.finished = 0
+        self.failed = list()
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._staged = threading.Event()
+
+    def _append(self, data):
+        if data["hash"] in self.hashes:
+            return  # Duplicated
+        self.hashes.add(data["hash"])
+
+        jobs = [JobItem(next(self._ids), data["site"], content)
+                for content in data["files"]]
+
+        with self._lock:
+            for job in jobs:
+                job.skip_exists = self.skip_exists
+                self.jobs[job._id] = job
+            self.total_bytes += data["byte"]
+
+        self.consumers.put_many(jobs,
+                                key=data["hash"],
+                                project=data["project"])
+
+    def run(self, job_file):
+        """Upload all packages in job file and wait till done
+
+        Args:
+            job_file (str): Job package file path
+
+        Returns:
+            int: Exit code, 0 if all files staged, and uploaded or skipped
+
+        """
+        started = time.time()
+        last_output = 0
+
+        errors = _ErrorCounter()
+        main_logger.addHandler(errors)
+
+        self.producer.start(resource=job_file,
+                            on_produce=self._append,
+                            on_complete=self._staged.set)
+        aborted = False
+        try:
+            while True:
+                try:
+                    self._update(self.pipe_out.get(timeout=self.interval))
+                except Empty:
+                    pass
+
+                now = time.time()
+                done = self._staged.is_set() and self._is_done()
+
+                if done or now - last_output >= self.interval:
+                    self._output(now - started, end=done)
+                    last_output = now
+
+                if done:
+                    break
+
+        except KeyboardInterrupt:
+            aborted = True
+            self.producer.stop()
+            main_logger.error("Interrupted.")
+            return 130
+
+        finally:
+            self.consumers.stop(abort=aborted)
+            main_logger.removeHandler(errors)
+
+        if errors.count:
+            main_logger.error("Errors occurred while staging.")
+            return 1
+
+        if not self.jobs:
+            main_logger.error("No file to upload.")
+            return 1
+
+        for job in self.failed:
+            src, dst, fsize = job.content
+            main_logger.error("Failed: %s -> %s: %s" % (src, dst, job.result))
+
+        return 1 if self.failed else 0
+
+    def _update(self, message):
+        process_id, reports = message
+
+        with self._lock:
+            for id, progress, result in reports:
+                job = self.jobs[id]
+                if process_id is not None:
+                    self.consumers.record(job,
+                                          progress - job.transferred,
+                                          result)
+                job.transferred = progress
+                job.result = result
+
+                if result == 1:
+                    self.finished += 1
+                elif result != 0:
+                    self.failed.append(job)
+
+    def _is_done(self):
+        with self._lock:
+            return self.finished + len(self.failed) == len(self.jobs)
+
+    def _output(self, elapsed, end=False):
+        with self._lock:
+            count = len(self.jobs)
+            transferred = sum(job.transferred for job in self.jobs.values())
+            total = self.total_bytes
+
+        speed = transferred / elapsed if elapsed else 0
+        if speed and not end:
+            eta = _format_time((total - transferred) / speed)
+        else:
+            eta = "-:--:--"
+
+        line = ("%d/%d files, %d failed, %s/%s, %s/s, ETA %s"
+                % (self.finished,
+                   count,
+                   len(self.failed),
+                   _format_size(transferred),
+                   _format_size(total),
+                   _format_size(speed),
+                   eta))
+
+        if self.stream.isatty():
+            self.stream.write("\r\033[K" + line + ("\n" if end else ""))
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+
+def upload(job_file,
+           workers=None,
+           bandwidth=None,
+           skip_exists=False,
+           interval=1.0,
+           demo=False):
+    """Upload job file without GUI
+
+    Args:
+        job_file (str): Job package file path
+        workers (int, optional): Number of workers per site
+        bandwidth (str, optional): Total bandwidth limit, e.g. "20M", or a
+            `throttle.Schedule` like "20M, 20:00-08:00=0"
+        skip_exists (bool, optional): Skip files which already exist and in
+            sync on remote
+        interval (float, optional): Seconds between progress output
+        demo (bool, optional): Run in demo-mode, nothing uploaded
+
+    Returns:
+        int: Exit code, 0 if all files uploaded or skipped
+
+    """
+    if demo:
+        from . import mock
+        session = Session(uploader=mock.MockUploader,
+                          producer=mock.MockPackageProducer,
+                          workers=workers,
+                          bandwidth=bandwidth,
+                          skip_exists=skip_exists,
+                          interval=interval)
+    else:
+        from . import worker
+        session = Session(uploader=worker.Uploader,
+                          producer=worker.PackageProducer,
+                          manifest=worker.RemoteManifest,
+                          workers=workers,
+                          bandwidth=bandwidth,
+                          skip_exists=skip_exists,
+                          interval=interval)
+
+    return session.run(job_file)
+
+
+def _bandwidth(value):
+    Schedule(value)  # Validate
+    return value
+
+
+def cli(args):
+    parser = argparse.ArgumentParser(prog="python -m avalon_sftpc upload",
+                                     description="Upload without GUI.")
+    parser.add_argument("job_file",
+                        help="Job package file, see `util.export`")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of upload processes per site")
+    parser.add_argument("--bandwidth", type=_bandwidth, default=None,
+                        help="Total bandwidth limit, e.g. 20M, or with "
+                             "schedule, e.g. '20M, 20:00-08:00=0'")
+    parser.add_argument("--skip-exists", action="store_true",
+                        help="Skip files which already exist on remote")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="Seconds between progress output")
+    parser.add_argument("--demo", action="store_true")
+
+    args = parser.parse_args(args)
+
+    if not main_logger.handlers:
+        main_logger.addHandler(logging.StreamHandler())
+    main_logger.setLevel(logging.INFO)
+
+    return upload(args.job_file,
+                  workers=args.workers,
+                  bandwidth=args.bandwidth,
+                  skip_exists=args.skip_exists,
+                  interval=args.interval,
+                  demo=args.demo)
@@ -0,0 +1,276 @@
+
+import os
+import io
+import json
+import gzip
+
+
+STREAM_THRESHOLD = 1024**2 * 16
+CHUNK_SIZE = 1024**2
+
+JSON = "json"
+JSONL = "jsonl"  # One package per line, with path prefixes factored out
+
+FORMAT_NAME = "avalon-sftpc-jobs"
+FORMAT_VERSION = 1
+
+GZIP = "gzip"
+ZSTD = "zstd"  # Requires `zstandard` module
+
+_MAGIC = {
+    GZIP: b"\x1f\x8b",
+    ZSTD: b"\x28\xb5\x2f\xfd",
+}
+
+
+class NotAListError(ValueError):
+    """Job package file is not a list of packages"""
+
+
+def write(path, packages, fmt=JSON, compress=None):
+    """Write out job package file
+
+    Args:
+        path (str): Output file path
+        packages (list): A list of upload package dicts
+        fmt (str, optional): `JSON` or `JSONL`, defaults to `JSON`
+        compress (str, optional): `GZIP` or `ZSTD`, defaults to None
+
+    """
+    if fmt not in (JSON, JSONL):
+        raise ValueError("Unknown job file format: %s" % fmt)
+
+    with _create(path, compress) as file:
+        if fmt == JSON:
+            json.dump(packages, file, indent=4)
+            return
+
+        header = {"format": FORMAT_NAME, "version": FORMAT_VERSION}
+        file.write(json.dumps(header) + "\n")
+        for package in packages:
+            file.write(json.dumps(_compact(package)) + "\n")
+
+
+def read(path):
+    """Iterate upload packages from job package file
+
+    The format and compression are detected from file content. Small plain
+    JSON file is loaded in one go, otherwise the file is parsed
+    incrementally so the first package can be digested while the rest is
+    still being read.
+
+    Args:
+        path (str): Job package file path
+
+    Raises:
+        NotAListError: If the file is not a list of packages
+        ValueError: If the file could not be parsed, this may be raised
+            after some packages have been yielded.
+
+    """
+    with open(path, "rb") as raw:
+        compress = _sniff(raw.read(4))
+
+    with _open(path, compress) as binary:
+        head = binary.peek(64).lstrip()
+
+        if head.startswith(b"{"):
+            file = io.TextIOWrapper(binary, encoding="utf-8")
+            for package in _iter_lines(file):
+                yield package
+
+        elif (compress is None and
+                os.path.getsize(path) < STREAM_THRESHOLD):
+            packages = json.loads(binary.read().decode("utf-8"))
+
+            if not isinstance(packages, list):
+                raise NotAListError("Should be a `list` of upload packages.")
+
+            for package in packages:
+                yield package
+
+        else:
+            file = io.TextIOWrapper(binary, encoding="utf-8")
+            for package in iter_list(file):
+                yield package
+
+
+def _sniff(magic):
+    for compress, prefix in _MAGIC.items():
+        if magic.startswith(prefix):
+            return compress
+    return None
+
+
+def _create(path, compress):
+    """Open text file for write with compression"""
+    if compress is None:
+        return open(path, "w")
+
+    if compress == GZIP:
+        # Fast level, since this usually runs inside DCC App
+        return gzip.open(path, "wt", compresslevel=1, encoding="utf-8")
+
+    if compress == ZSTD:
+        import zstandard
+        binary = zstandard.open(path, "wb")
+        return io.TextIOWrapper(binary, encoding="utf-8")
+
+    raise ValueError("Unknown compression: %s" % compress)
+
+
+def _open(path, compress):
+    """Open binary file for read with decompression, peekable"""
+    if compress is None:
+        return open(path, "rb")
+
+    if compress == GZIP:
+        return io.BufferedReader(gzip.open(path, "rb"))
+
+    if compress == ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("Module `zstandard` is required for reading "
+                             "zstd compressed job file.")
+        return io.BufferedReader(zstandard.open(path, "rb"))
+
+
+def _common_dir(paths):
+    """Return the longest common dir prefix, with trailing separator"""
+    prefix = os.path.commonprefix(paths)
+    cut = max(prefix.rfind("/"), prefix.rfind("\\"))
+    return prefix[:cut + 1]
+
+
+def _compact(package):
+    """Factor out common path prefixes of package files"""
+    files = package["files"]
+    local_root = _common_dir([src for src, dst in files])
+    remote_root = _common_dir([dst for src, dst in files])
+    local_cut = len(local_root)
+    remote_cut = len(remote_root)
+
+    compact = dict(package)
+    compact["local_root"] = local_root
+    compact["remote_root"] = remote_root
+    compact["files"] = [(src[local_cut:], dst[remote_cut:])
+                        for src, dst in files]
+    return compact
+
+
+def _iter_lines(file):
+    """Iterate packages from `JSONL` formatted file"""
+    header = json.loads(file.readline())
+    if header.get("format") != FORMAT_NAME:
+        raise ValueError("Unknown job file format.")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError("Job file version %s is not supported."
+                         % header["version"])
+
+    for line in file:
+        if not line.strip():
+            continue
+
+        package = json.loads(line)
+        local_root = package.pop("local_root")
+        remote_root = package.pop("remote_root")
+        package["files"] = [(local_root + src, remote_root + dst)
+                            for src, dst in package["files"]]
+        yield package
+
+
+def iter_list(file, chunk_size=CHUNK_SIZE):
+    """Incrementally yield items of the top-level JSON array in file
+
+    Args:
+        file (file): Opened text file
+        chunk_size (int, optional): Size of each read, doubled when a
+            single item does not fit in buffer
+
+    """
+    decoder = json.JSONDecoder()
+    reader = _Reader(file, chunk_size)
+
+    if reader.next_char() != "[":
+        raise NotAListError("Should be a `list` of upload packages.")
+    reader.pos += 1
+
+    if reader.next_char() == "]":
+        return
+
+    while True:
+        reader.next_char()
+        yield reader.decode(decoder)
+
+        char = reader.next_char()
+        reader.pos += 1
+        if char == "]":
+            break
+        if char != ",":
+            raise ValueError("Expecting ',' delimiter at %d"
+                             % reader.offset())
+
+
+class _Reader(object):
+    """Buffered text reader for `iter_list`"""
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.consumed = 0  # Length of text dropped from buffer
+        self.eof = False
+
+    def offset(self):
+        return self.consumed + self.pos
+
+    def fill(self, size):
+        """Drop parsed text and read more, return False if nothing read"""
+        if self.eof:
+            return False
+
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+        return True
+
+    def next_char(self):
+        """Skip whitespaces and return next character"""
+        while True:
+            buffer = self.buffer
+            length = len(buffer)
+            while self.pos < length and buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < length:
+                return buffer[self.pos]
+            if not self.fill(self.chunk_size):
+                raise ValueError("Unexpected end of file at %d"
+                                 % self.offset())
+
+    def decode(self, decoder):
+        """Decode one JSON value at current position"""
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Incomplete, read more then try again
+                if not self.fill(size):
+                    raise
+                size *= 2
+                continue
+
+            if end == len(self.buffer) and self.fill(size):
+                # Value may continue in next chunk (e.g. a number), retry
+                continue
+
+            self.pos = end
+            return value
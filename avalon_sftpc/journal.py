@@ -0,0 +1,263 @@
+
+import os
+import json
+import time
+import logging
+import threading
+
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue
+
+
+main_logger = logging.getLogger("avalon-sftpc")
+
+
+PENDING = 0
+COMPLETED = 1
+FAILED = -1
+
+
+def default_path():
+    """Return upload journal file path
+
+    Set by environment variable `AVALON_SFTPC_JOURNAL`, defaults to
+    `~/.avalon-sftpc/journal.db`.
+
+    """
+    default = os.path.join(os.path.expanduser("~"),
+                           ".avalon-sftpc",
+                           "journal.db")
+    return os.getenv("AVALON_SFTPC_JOURNAL", default)
+
+
+class Journal(object):
+    """On-disk record of queued packages and their jobs' progress
+
+    Packages are added when queued and removed once all their files are
+    uploaded, so what is left after a crash or quit are the unfinished
+    ones, see `unfinished`.
+
+    Records are appended to a queue and written by a background thread in
+    one SQLite transaction every `COMMIT_INTERVAL` seconds, progress of the
+    same job within a transaction is written once. The database is in WAL
+    mode, a commit is an append to the log without syncing to disk, so it
+    survives the app crashing, not the machine losing power.
+
+    Args:
+        path (str, optional): Database file path, defaults to
+            `default_path()`
+
+    """
+
+    COMMIT_INTERVAL = 0.5
+    TIMEOUT = 30
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._records = _queue.Queue()
+        self._db = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+
+        import sqlite3
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        db = sqlite3.connect(self.path,
+                             timeout=self.TIMEOUT,
+                             check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS packages ("
+                   "key TEXT PRIMARY KEY, "
+                   "data TEXT, "
+                   "skip_exists INTEGER, "
+                   "priority INTEGER, "
+                   "queued REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                   "key TEXT, "
+                   "dst TEXT, "
+                   "transferred INTEGER, "
+                   "result INTEGER, "
+                   "PRIMARY KEY (key, dst)) WITHOUT ROWID")
+        db.commit()
+        self._db = db
+
+        return db
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                self._connect()
+                self._writer = threading.Thread(target=self._write,
+                                                daemon=True)
+                self._writer.start()
+
+    def add(self, key, data, skip_exists=True, priority=0, reset=False):
+        """Record a queued package
+
+        Args:
+            key (str): Package identity
+            data (dict): Package data to restore from, with `files`
+            skip_exists (bool, optional): Package's skip exists option
+            priority (int, optional): Package priority
+            reset (bool, optional): Forget progress of package's jobs
+
+        """
+        self._start()
+        self._records.put(("add", key, data, skip_exists, priority, reset))
+
+    def update(self, key, dst, transferred, result):
+        """Record job progress
+
+        Args:
+            key (str): Package identity
+            dst (str): Job's remote path
+            transferred (int): Bytes transferred
+            result (int or Exception): Job result, 0 if in progress
+
+        """
+        if result not in (PENDING, COMPLETED):
+            result = FAILED
+        self._records.put(("job", (key, dst), transferred, result))
+
+    def set_priority(self, key, priority):
+        self._records.put(("priority", key, priority))
+
+    def finish(self, key):
+        """Forget a package which has been fully uploaded"""
+        self._records.put(("finish", key))
+
+    def discard(self, keys):
+        """Forget packages, e.g. the ones not to restore"""
+        self._start()
+        for key in keys:
+            self._records.put(("finish", key))
+        self.flush()
+
+    def unfinished(self):
+        """Return packages which were not fully uploaded
+
+        Returns:
+            list: Dicts of package `data`, `skip_exists`, `priority` and
+                `jobs`, which maps job's remote path to transferred bytes
+                and result, in the order they were queued
+
+        """
+        self.flush()
+        with self._lock:
+            db = self._connect()
+            packages = db.execute("SELECT key, data, skip_exists, priority "
+                                  "FROM packages ORDER BY queued").fetchall()
+            jobs = db.execute("SELECT key, dst, transferred, result "
+                              "FROM jobs").fetchall()
+
+        by_key = dict()
+        for key, dst, transferred, result in jobs:
+            by_key.setdefault(key, dict())[dst] = (transferred, result)
+
+        entries = list()
+        for key, data, skip_exists, priority in packages:
+            data = json.loads(data)
+            data["files"] = [tuple(content) for content in data["files"]]
+            entries.append({
+                "key": key,
+                "data": data,
+                "skip_exists": bool(skip_exists),
+                "priority": priority,
+                "jobs": by_key.get(key, dict()),
+            })
+
+        return entries
+
+    def flush(self):
+        """Write all records now"""
+        with self._lock:
+            if self._writer is None:
+                return
+            self._commit(self._drain())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._writer = None
+
+    def _drain(self):
+        records = list()
+        while True:
+            try:
+                records.append(self._records.get_nowait())
+            except _queue.Empty:
+                return records
+
+    def _write(self):
+        while True:
+            time.sleep(self.COMMIT_INTERVAL)
+            with self._lock:
+                if self._db is None:
+                    return  # Closed
+                try:
+                    self._commit(self._drain())
+                except Exception as error:
+                    main_logger.error("Journal write failed: %s" % error)
+
+    def _commit(self, records):
+        if not records:
+            return
+
+        db = self._db
+        jobs = dict()  # (key, dst): (transferred, result)
+
+        def write_jobs():
+            db.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+                           [key + value for key, value in jobs.items()])
+            jobs.clear()
+
+        for record in records:
+            kind = record[0]
+            if kind == "job":
+                jobs[record[1]] = record[2:]
+                continue
+
+            # Keep records in order
+            if jobs:
+                write_jobs()
+
+            if kind == "add":
+                key, data, skip_exists, priority, reset = record[1:]
+                if reset:
+                    db.execute("DELETE FROM jobs WHERE key = ?", (key,))
+                # Requeued package keeps its place
+                db.execute("INSERT OR REPLACE INTO packages "
+                           "SELECT ?, ?, ?, ?, COALESCE(("
+                           "SELECT queued FROM packages WHERE key = ?), ?)",
+                           (key,
+                            json.dumps(data),
+                            int(skip_exists),
+                            priority,
+                            key,
+                            time.time()))
+
+            elif kind == "priority":
+                db.execute("UPDATE packages SET priority = ? WHERE key = ?",
+                           (record[2], record[1]))
+
+            elif kind == "finish":
+                db.execute("DELETE FROM packages WHERE key = ?", (record[1],))
+                db.execute("DELETE FROM jobs WHERE key = ?", (record[1],))
+
+        if jobs:
+            write_jobs()
+
+        db.commit()
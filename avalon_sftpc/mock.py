@@ -3,60 +3,50 @@ import os
 import random
 import tempfile
 import shutil
-from multiprocessing import Process
-from .worker import PackageProducer
+from . import backends
+from .worker import Uploader, PackageProducer, Aborted
 
 
-_STOP = "STOP"
-
-
-class MockUploader(Process):
+class MockUploader(Uploader):
 
+    BACKENDS = (backends.PROCESS, backends.THREAD)
     mock_upload_speed = 500
     mock_error_rate = 0.999999
     max_error_count = 2
 
-    def __init__(self, pipe_in, pipe_out, process_id):
-        super(MockUploader, self).__init__()
-        self.pipe_in = pipe_in
-        self.pipe_out = pipe_out
-        self._id = process_id
-        self.consuming = False
-
-    def stop(self):
-        self.pipe_in.put(_STOP)
-
-    def run(self):
-
-        while True:
-            job = self.pipe_in.get()
-
-            if job == _STOP:
-                break
-
-            src, dst, fsize = job.content
-
-            # Compute
-            chunk_size = self.mock_upload_speed
-            steps = int(fsize / chunk_size)
-            remain = fsize % chunk_size
-            chunks = [chunk_size] * steps + [remain]
-
-            try:
-                for chunk in chunks:
-                    job.transferred += chunk
-                    self.pipe_out.put((job._id, job.transferred, 0, self._id))
-
-                    # Simulate error
-                    dice = random.random()
-                    if self.max_error_count and dice > self.mock_error_rate:
-                        self.max_error_count -= 1
-                        raise IOError("This is not what I want.")
-
-            except Exception as error:
-                self.pipe_out.put((job._id, fsize, error, self._id))
-            else:
-                self.pipe_out.put((job._id, job.transferred, 1, self._id))
+    def _process(self, job):
+        src, dst, fsize = job.content
+
+        # Compute
+        chunk_size = self.mock_upload_speed
+        steps = int(fsize / chunk_size)
+        remain = fsize % chunk_size
+        chunks = [chunk_size] * steps + [remain]
+
+        # Job may be shared with the model (thread backend), not to touch
+        transferred = 0
+
+        try:
+            for chunk in chunks:
+                if self.aborted.is_set():
+                    raise Aborted("Upload aborted.")
+                transferred += chunk
+                self.reporter.progress(job._id, transferred)
+
+                # Simulate error
+                dice = random.random()
+                if self.max_error_count and dice > self.mock_error_rate:
+                    self.max_error_count -= 1
+                    raise IOError("This is not what I want.")
+
+        except Exception as error:
+            self.reporter.finish(job._id, fsize, error)
+        else:
+            self.reporter.finish(job._id, transferred, 1)
+
+    def _process_batch(self, jobs):
+        for job in jobs:
+            self._process(job)
 
 
 class MockPackageProducer(PackageProducer):
@@ -1,11 +1,13 @@
 
 import logging
+import itertools
 import threading
 from multiprocessing import Queue
 from weakref import WeakValueDictionary
 
-from avalon import io
-from avalon.vendor import qtawesome
+from .pool import WorkerPool, JobItem
+from .journal import COMPLETED
+
 from avalon.vendor.Qt import QtCore
 from avalon.tools.models import TreeModel, Item
 
@@ -15,38 +17,30 @@ main_logger = logging.getLogger("avalon-sftpc")
 
 _Uploader = None
 _PackageProducer = None
+_RemoteManifest = None
+_Journal = None
 # ^^^
 # For the scenario like generating job package in Maya, which in an environment
 # that may not have the dependency module `pysftp` installed, but requires and
 # only needs to access `.util`, we need to delay import stuff from `work.py` so
 # the `ImportError` can be avoided.
 #
-# Above two attributes were get assigned when `app.show` is called, and depends
+# Above attributes were get assigned when `app.show` is called, and depends
 # on *demo* enabled or not, use different classes:
 #
 # if demo:
 #     _Uploader = mock.MockUploader
 #     _PackageProducer = mock.MockPackageProducer
+#     _RemoteManifest = None
+#     _Journal = None
 # else:
 #     _Uploader = worker.Uploader
 #     _PackageProducer = worker.PackageProducer
+#     _RemoteManifest = worker.RemoteManifest
+#     _Journal = journal.Journal
 #
 
-
-class JobItem(object):
-    """
-    """
-
-    __slots__ = ("_id", "site", "content", "skip_exists", "transferred",
-                 "result", "__weakref__")
-
-    def __init__(self, job_id, site, content):
-        self._id = str(job_id)
-        self.site = site
-        self.content = content
-        self.skip_exists = True
-        self.transferred = 0
-        self.result = 0
+_job_ids = itertools.count()
 
 
 class PackageItem(Item):
@@ -56,13 +50,45 @@ class PackageItem(Item):
     def __init__(self, data):
         self.byte = data.pop("byte")  # To comput progress
         self.hash = data.pop("hash")
-        self.jobs = [JobItem(io.ObjectId(), data["site"], content)
+        self.jobs = [JobItem(next(_job_ids), data["site"], content)
                      for content in data["files"]]
         self.total = len(self.jobs)
+        self.skip_exists = True
+        # Running totals of jobs, see `report`
+        self.transferred = 0
+        self.uploaded = 0
+        self.errored = 0
 
         super(PackageItem, self).__init__(data)
 
         self["progress"] = self.progress
+        self["priority"] = 0  # Higher is uploaded first, see `scheduler`
+
+    def report(self, job, transferred, result):
+        """Update job's progress and package's running totals
+
+        Args:
+            job (JobItem): One of this package's jobs
+            transferred (int): Job's transferred bytes
+            result (int or Exception): Job's result, 0 for pending
+
+        """
+        self.transferred += transferred - job.transferred
+
+        if result != job.result:
+            self._count(job.result, -1)
+            self._count(result, 1)
+
+        job.transferred = transferred
+        job.result = result
+
+    def _count(self, result, step):
+        if result == 0:
+            pass  # Still pending
+        elif result == 1:
+            self.uploaded += step
+        else:
+            self.errored += step
 
     def progress(self):
         """Return transfer progress percentage
@@ -71,19 +97,8 @@ class PackageItem(Item):
             float: Upload progress percentage
 
         """
-        uploaded = 0
-        errored = False
-        transferred = 0
-
-        for job in self.jobs:
-            transferred += job.transferred
-
-            if job.result == 0:
-                pass  # Still pending
-            elif job.result == 1:
-                uploaded += 1
-            else:
-                errored = True
+        transferred = self.transferred
+        errored = self.errored > 0
 
         if transferred > 0:
             if transferred < self.byte:
@@ -97,24 +112,37 @@ class PackageItem(Item):
                 else:
                     self["status"] = 5  # End with error
 
-        return transferred / self.byte * 100, uploaded, self.total
+        return transferred / self.byte * 100, self.uploaded, self.total
+
+    def dump(self):
+        """Return package data to recreate this package from"""
+        data = {key: self[key] for key in ("project",
+                                           "type",
+                                           "description",
+                                           "site",
+                                           "files",
+                                           "count",
+                                           "size")}
+        data["status"] = 0
+        data["byte"] = self.byte
+        data["hash"] = self.hash
+        return data
 
     def __eq__(self, other):
         # Assume we only compare with other `PackageItem` instance
         return self.hash == other.hash
 
     def __hash__(self):
-        return self.hash
+        return hash(self.hash)
 
 
 class JobSourceModel(TreeModel):  # QueueModel ?
 
-    MAX_CONNECTIONS = 10
-
     staging = QtCore.Signal()
     staged = QtCore.Signal()
     canceling = QtCore.Signal()
     canceled = QtCore.Signal()
+    progressed = QtCore.Signal()  # Emitted from update thread when idle
 
     STAGING_COLUMNS = [
         "project",
@@ -134,6 +162,7 @@ class JobSourceModel(TreeModel):  # QueueModel ?
         "description",
         "status",  # This has been hidden
         "progress",
+        "priority",
     ]
 
     UploadDisplayRole = QtCore.Qt.UserRole + 20
@@ -150,6 +179,8 @@ class JobSourceModel(TreeModel):  # QueueModel ?
         "endWithError",
     ]
 
+    REFRESH_FPS = 10  # Max progress repaints per second
+
     STATUS_ICON = [
         ("meh-o", "#999999"),
         ("clock-o", "#95A1A5"),
@@ -163,14 +194,31 @@ class JobSourceModel(TreeModel):  # QueueModel ?
         super(JobSourceModel, self).__init__(parent=parent)
 
         self.jobsref = WeakValueDictionary()
-        self.pipe_in = Queue()
+        self._packages = dict()  # package hash: latest staged package
+        self.packagesref = WeakValueDictionary()  # job id: package
         self.pipe_out = Queue()
 
         self.producer = _PackageProducer()
-        self.consumers = [_Uploader(self.pipe_in, self.pipe_out, id)
-                          for id in range(self.MAX_CONNECTIONS)]
+        # Workers are spawned per site on first job, see `pool.WorkerPool`
+        self.consumers = WorkerPool(_Uploader,
+                                    self.pipe_out,
+                                    manifest=_RemoteManifest)
+        # Record of queued packages for restoring after restart
+        self.journal = _Journal() if _Journal is not None else None
+        # Packages which have progressed since last refresh, collected by
+        # update thread and emitted as `dataChanged` by `_refresh` in GUI
+        # thread, the timer runs only while there are progresses.
+        self._touched = dict()  # id: package
+        self._touched_lock = threading.Lock()
+        self._refreshing = False
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setInterval(1000 // self.REFRESH_FPS)
+        self._refresh_timer.timeout.connect(self._refresh)
+        self.progressed.connect(self._refresh_timer.start)
+
         self.consume()
 
+        from avalon.vendor import qtawesome
         self.status_icon = [
             qtawesome.icon("fa.{}".format(icon), color=color)
             for icon, color in self.STATUS_ICON
@@ -180,7 +228,7 @@ class JobSourceModel(TreeModel):  # QueueModel ?
         return self.producer.producing
 
     def is_uploading(self):
-        return any(c.consuming for c in self.consumers)
+        return self.consumers.is_uploading()
 
     def stage(self, job_file):
         """
@@ -200,90 +248,258 @@ class JobSourceModel(TreeModel):  # QueueModel ?
         package = PackageItem(data)
 
         # Check duplicated
-        all_nodes = self._root_item.children()
-        if package in all_nodes:
+        latest = self._packages.get(package.hash)
+        if latest is not None:
             # If duplicated package has completed, allow to stage
             # again.
-            find = list(reversed(all_nodes))
-            if find[find.index(package)]["status"] <= 2:
+            if latest["status"] <= 2:
                 return
 
-        # Start
+        self._insert(package)
+
+    def _insert(self, package):
         root = QtCore.QModelIndex()
         last = self.rowCount(root)
 
         self.beginInsertRows(root, last, last)
         self.add_child(package)
+        self._packages[package.hash] = package
         self.endInsertRows()
 
-    def stop(self):
-        """Stop all activities"""
+    def _reindex(self):
+        """Rebuild package hash index from remaining packages"""
+        self._packages = dict()
+        for package in self._root_item.children():
+            self._packages[package.hash] = package  # Latest wins
+
+    def clear(self):
+        super(JobSourceModel, self).clear()
+        self._packages = dict()
+
+    def stop(self, abort=False):
+        """Stop all activities
+
+        Block until all uploader processes exited, see `WorkerPool.stop`.
+
+        Args:
+            abort (bool, optional): Interrupt the files in upload instead of
+                waiting for them to finish
+
+        """
         if self.producer.producing:
             self.producer.stop()
 
-        for consumer in self.consumers:
-            consumer.stop()
+        self.canceling.emit()
+        self.consumers.stop(abort=abort)
+        if self.journal is not None:
+            self.journal.close()
+        self.canceled.emit()
 
-        if self.is_staging() or self.is_uploading():
-            # Wait till they both stopped.
-            self.canceling.emit()
-            while self.is_staging() or self.is_uploading():
-                pass
-            self.canceled.emit()
+    def set_bandwidth(self, rate, site=None):
+        """Limit upload bandwidth at runtime, see `WorkerPool.set_bandwidth`
+        """
+        self.consumers.set_bandwidth(rate, site=site)
 
     def pending(self, index, skip_exists):
         package = self.data(index, self.ItemRole)
         package["status"] = 1
+        package.skip_exists = skip_exists
         self.dataChanged.emit(index, index, list())
 
         for job in package.jobs:
             job.skip_exists = skip_exists
-            self.pipe_in.put(job)
             self.jobsref[job._id] = job
+            self.packagesref[job._id] = package
+        self._put(package, package.jobs)
 
     def requeue_failed(self, package):
+        jobs = list()
         for job in package.jobs:
             if job.result in (0, 1):
                 # (TODO) Maybe add another list attribute to hold failed
                 #        job in package ?
                 continue
             # Reset
-            job.transferred = 0
-            job.result = 0
+            package.report(job, 0, 0)
+            job.skip_exists = package.skip_exists
             # Requeue
-            self.pipe_in.put(job)
             self.jobsref[job._id] = job
+            self.packagesref[job._id] = package
+            jobs.append(job)
+        self._put(package, jobs)
 
     def requeue_all(self, package):
         for job in package.jobs:
             # Reset
-            job.transferred = 0
-            job.result = 0
+            package.report(job, 0, 0)
+            job.skip_exists = package.skip_exists
             # Requeue
-            self.pipe_in.put(job)
             self.jobsref[job._id] = job
+            self.packagesref[job._id] = package
+        self._put(package, package.jobs, reset=True)
+
+    def _put(self, package, jobs, reset=False):
+        if self.journal is not None:
+            self.journal.add(package.hash,
+                             package.dump(),
+                             skip_exists=package.skip_exists,
+                             priority=package["priority"],
+                             reset=reset)
+
+        self.consumers.put_many(jobs,
+                                key=package.hash,
+                                project=package["project"],
+                                priority=package["priority"])
+
+    def prioritize(self, packages, first=True):
+        """Upload packages before or after all the others
+
+        Packages' pending files are rescheduled right away, files that are
+        in upload are not interrupted.
+
+        Args:
+            packages (list): `PackageItem`s
+            first (bool, optional): Upload first, or last if False
+
+        """
+        others = [node["priority"] for node in self._root_item.children()
+                  if node not in packages]
+        if first:
+            priority = max(others or [0]) + 1
+        else:
+            priority = min(others or [0]) - 1
+
+        column = self.UPLOAD_COLUMNS.index("priority")
+        for package in packages:
+            package["priority"] = priority
+            self.consumers.set_priority(package.hash, priority)
+            if self.journal is not None:
+                self.journal.set_priority(package.hash, priority)
+
+            index = self.createIndex(package.row(), column, package)
+            self.dataChanged.emit(index, index, list())
+
+    def unfinished(self):
+        """Return packages that were not fully uploaded in last session
+
+        See `journal.Journal.unfinished`.
+
+        """
+        if self.journal is None:
+            return list()
+        return self.journal.unfinished()
+
+    def restore(self, entries):
+        """Queue unfinished packages of last session
+
+        Only the files which were not uploaded are queued again.
+
+        Args:
+            entries (list): Packages from `unfinished`
+
+        """
+        for entry in entries:
+            package = PackageItem(entry["data"])
+            if package.hash in self._packages:
+                continue
+
+            package["status"] = 1
+            package["priority"] = entry["priority"]
+            package.skip_exists = entry["skip_exists"]
+
+            # Unfinished ones start from 0, the worker reports the offset
+            # it resumes from once the partial file on remote is checked
+            jobs = list()
+            for job in package.jobs:
+                src, dst, fsize = job.content
+                _, result = entry["jobs"].get(dst, (0, 0))
+                if result == COMPLETED:
+                    package.report(job, fsize, 1)
+                    continue
+
+                job.skip_exists = package.skip_exists
+                self.jobsref[job._id] = job
+                self.packagesref[job._id] = package
+                jobs.append(job)
+
+            self._insert(package)
+            if jobs:
+                self._put(package, jobs)
+            else:
+                self.journal.finish(package.hash)
+
+    def forget(self, entries):
+        """Drop unfinished packages of last session from journal"""
+        self.journal.discard([entry["key"] for entry in entries])
 
     def consume(self):
-        for c in self.consumers:
-            c.start()
+        journal = self.journal
 
         def update():
             while True:
-                id, progress, result, process_id = self.pipe_out.get()
-                job = self.jobsref[id]
-                job.transferred = progress
-                job.result = result
-
-                if result == 0:
-                    # Still uploading
-                    self.consumers[process_id].consuming = True
-                else:
-                    # Upload completed or error occurred
-                    self.consumers[process_id].consuming = False
+                # Reports are batched, see `worker.ProgressReporter`
+                process_id, reports = self.pipe_out.get()
+                touched = dict()
+
+                for job_id, progress, result in reports:
+                    job = self.jobsref[job_id]
+                    package = self.packagesref[job_id]
+                    if process_id is not None:
+                        self.consumers.record(job,
+                                              progress - job.transferred,
+                                              result)
+                    package.report(job, progress, result)
+                    touched[id(package)] = package
+
+                    if journal is not None:
+                        journal.update(package.hash,
+                                       job.content[1],
+                                       progress,
+                                       result)
+                        if result == 1 and package.uploaded == package.total:
+                            journal.finish(package.hash)
+
+                with self._touched_lock:
+                    self._touched.update(touched)
+                if not self._refreshing:
+                    self._refreshing = True
+                    self.progressed.emit()
 
         updator = threading.Thread(target=update, daemon=True)
         updator.start()
 
+    def _refresh(self):
+        """Emit `dataChanged` on progress of packages that have progressed
+        """
+        self._refreshing = False
+        with self._touched_lock:
+            touched, self._touched = self._touched, dict()
+
+        if not touched:
+            self._refresh_timer.stop()
+            return
+        self._refreshing = True
+
+        column = self.UPLOAD_COLUMNS.index("progress")
+        all_nodes = self._root_item.children()
+        rows = sorted(row for row, node in enumerate(all_nodes)
+                      if id(node) in touched)
+
+        # Packages are uploaded in queued order, so the touched rows are
+        # mostly adjacent, emit once per run of rows.
+        runs = list()
+        for row in rows:
+            if runs and runs[-1][1] == row - 1:
+                runs[-1][1] = row
+            else:
+                runs.append([row, row])
+
+        for first, last in runs:
+            top = self.createIndex(first, column, all_nodes[first])
+            bottom = self.createIndex(last, column, all_nodes[last])
+            # passing `list()` for PyQt5 (see PYSIDE-462)
+            self.dataChanged.emit(top, bottom, list())
+
     def clear_stage(self):
         all_nodes = self._root_item.children()
 
@@ -292,15 +508,17 @@ class JobSourceModel(TreeModel):  # QueueModel ?
             self.clear()
             return
 
-        # Remove staged only
+        # Remove staged only, by position since packages of same hash are
+        # equal
         root = QtCore.QModelIndex()
-        for node in list(all_nodes):
-            if node.get("status", 0) == 0:
-                row = node.row()
+        for row in reversed(range(len(all_nodes))):
+            if all_nodes[row].get("status", 0) == 0:
                 self.beginRemoveRows(root, row, row)
-                all_nodes.remove(node)
+                del all_nodes[row]
                 self.endRemoveRows()
 
+        self._reindex()
+
     def columnCount(self, parent):
         return max(len(self.STAGING_COLUMNS), len(self.UPLOAD_COLUMNS))
 
@@ -334,7 +552,7 @@ class JobSourceModel(TreeModel):  # QueueModel ?
 
         if role == self.UploadErrorRole:
             node = index.internalPointer()
-            if any(job.result not in (0, 1) for job in node.jobs):
+            if node.errored:
                 return node  # Only return package that has failed job
             else:
                 return None
@@ -0,0 +1,746 @@
+
+import time
+import logging
+import functools
+import itertools
+import threading
+from multiprocessing import Queue
+
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue
+
+from . import backends, config, throttle
+from .scheduler import Scheduler
+
+
+main_logger = logging.getLogger("avalon-sftpc")
+
+DRAIN_TIMEOUT = 300  # Seconds to wait for current files before aborting
+ABORT_TIMEOUT = 10  # Seconds to wait for aborted workers to clean up
+
+
+class JobItem(object):
+    """One file to upload, shared between GUI and headless mode
+
+    Args:
+        job_id (str): Unique id for progress report
+        site (str): Site name
+        content (tuple): Local path, remote path and file size
+
+    """
+
+    __slots__ = ("_id", "site", "content", "skip_exists", "transferred",
+                 "result", "__weakref__")
+
+    def __init__(self, job_id, site, content):
+        self._id = str(job_id)
+        self.site = site
+        self.content = content
+        self.skip_exists = True
+        self.transferred = 0
+        self.result = 0
+
+
+class WorkerGroup(object):
+    """Uploader processes that serve one site
+
+    All workers in a group consume from the same job queue, so the number
+    of live workers is the number of concurrent streams to the site.
+
+    Jobs wait in a `Scheduler` and are moved into the queue by a dispatcher
+    thread, one per free worker. Small files may be queued ahead, up to
+    `PREFETCH` items per worker, to save workers a round trip between
+    them. Big files are never queued ahead, so a job with higher priority
+    is picked up by the next free worker.
+
+    Workers are started on first job, and exit after the group has been
+    idle for `idle_timeout`, see `park`. They are started again when more
+    jobs come.
+
+    Args:
+        site (str): Site name
+        uploader (type): `Uploader` class to spawn
+        pipe_out (multiprocessing.Queue): Progress report queue, shared by
+            all groups
+        next_id (callable): Return a new, pool-wide unique process id
+        workers (int): Initial number of workers
+        adaptive (bool): Whether to auto-scale workers at runtime
+        min_workers (int): Lower bound of auto-scaling
+        max_workers (int): Upper bound of auto-scaling
+        batch_size (int): Max number of small files per batch, batching is
+            disabled if less than 2
+        small_file (int): Max size in bytes of file that can be batched
+        throttle (throttle.Throttle, optional): Bandwidth limit of workers
+        pipe_in (queue, optional): Job queue of the workers, defaults to a
+            `multiprocessing.Queue`
+        idle_timeout (float, optional): Seconds to keep idle workers, 0 to
+            keep them forever
+
+    """
+
+    BATCH_BYTES = 1024**2 * 8
+    PREFETCH = 2  # Queue items per worker
+
+    def __init__(self,
+                 site,
+                 uploader,
+                 pipe_out,
+                 next_id,
+                 workers,
+                 adaptive=False,
+                 min_workers=1,
+                 max_workers=None,
+                 batch_size=32,
+                 small_file=1024**2,
+                 throttle=None,
+                 pipe_in=None,
+                 idle_timeout=0):
+
+        self.site = site
+        self.pipe_in = pipe_in if pipe_in is not None else Queue()
+        self.pipe_out = pipe_out
+        self.workers = list()
+
+        self.adaptive = adaptive
+        self.min_workers = min_workers
+        self.max_workers = max_workers or workers
+        self.batch_size = batch_size
+        self.small_file = small_file
+        self.throttle = throttle
+        self.idle_timeout = idle_timeout
+
+        self._uploader = uploader
+        self._next_id = next_id
+        self._lock = threading.Lock()
+        self._dispatchable = threading.Condition(self._lock)
+        self._resizing = threading.RLock()
+        self._closed = False
+        self._parked = 0  # Number of workers to start on next job
+        self._active = time.time()
+        # Queue items not yet finished, and job id to the item's remaining
+        # job count, see `record`
+        self._in_flight = 0
+        self._items = dict()
+        self.scheduler = Scheduler()
+        # Counters for measuring throughput
+        self.queued = 0
+        self.transferred = 0
+        self.finished = 0
+        self.errored = 0
+
+        self.resize(workers)
+
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def size(self):
+        return len(self.workers)
+
+    def resize(self, count):
+        """Grow or shrink the number of live workers
+
+        Shrinking retires the excess workers, each of them exits after
+        finishing its current file.
+
+        Args:
+            count (int): Number of workers wanted
+
+        """
+        count = max(self.min_workers, min(count, self.max_workers))
+
+        with self._resizing:
+            started = time.time()
+            spawned = 0
+            while len(self.workers) < count:
+                worker = self._uploader(self.pipe_in,
+                                        self.pipe_out,
+                                        self._next_id(),
+                                        throttle=self.throttle)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+                spawned += 1
+
+            while len(self.workers) > count:
+                worker = self.workers.pop()
+                worker.retire()
+
+            if spawned:
+                main_logger.debug("Site '%s': started %d workers in %.3fs."
+                                  % (self.site, spawned,
+                                     time.time() - started))
+
+        with self._lock:
+            self._dispatchable.notify()
+
+    def put(self, job, **options):
+        self.put_many([job], **options)
+
+    def put_many(self, jobs, key=None, project=None, priority=None):
+        """Schedule jobs of one package
+
+        Args:
+            jobs (list): `JobItem`s
+            key (hashable, optional): Package identity
+            project (str, optional): Project name, for fair sharing
+            priority (int, optional): Package priority, higher goes first
+
+        See `Scheduler.put`.
+
+        """
+        self.scheduler.put(jobs, key=key, project=project, priority=priority)
+        with self._lock:
+            self.queued += len(jobs)
+            self._active = time.time()
+            self._dispatchable.notify()
+
+        with self._resizing:
+            if self._parked and not self._closed:
+                count, self._parked = self._parked, 0
+                self.resize(count)
+
+    def park(self):
+        """Retire all workers if the group has been idle for `idle_timeout`
+
+        They are started again, as many as they were, by next `put_many`.
+
+        Returns:
+            bool: True if workers were retired
+
+        """
+        with self._resizing:
+            with self._lock:
+                idle = (self.idle_timeout and
+                        self.workers and
+                        not self._closed and
+                        not self._in_flight and
+                        not len(self.scheduler) and
+                        time.time() - self._active >= self.idle_timeout)
+            if not idle:
+                return False
+
+            self._parked = len(self.workers)
+            while self.workers:
+                self.workers.pop().retire()
+
+        main_logger.debug("Site '%s': idle, retired %d workers."
+                          % (self.site, self._parked))
+        return True
+
+    def set_priority(self, key, priority):
+        self.scheduler.set_priority(key, priority)
+        with self._lock:
+            self._dispatchable.notify()
+
+    def close(self):
+        """Stop dispatching, jobs not yet dispatched are dropped"""
+        with self._resizing, self._lock:
+            self._closed = True
+            self.scheduler.clear()
+            self._dispatchable.notify()
+
+    def _dispatch(self):
+        """Move jobs from scheduler into queue while workers are short of
+
+        Small files are grouped into batches, a batch is a list of jobs
+        which one worker uploads with requests pipelined over one SFTP
+        channel.
+
+        """
+        while True:
+            with self._lock:
+                while not self._closed and not self._ready():
+                    self._dispatchable.wait()
+                if self._closed:
+                    return
+
+                if self.batch_size < 2:
+                    jobs = self.scheduler.pop()
+                else:
+                    jobs = self.scheduler.pop(self.batch_size,
+                                              self.BATCH_BYTES,
+                                              self.small_file)
+                if not jobs:
+                    continue
+
+                self._in_flight += 1
+                remaining = [len(jobs)]
+                for job in jobs:
+                    self._items[job._id] = remaining
+
+            self.pipe_in.put(jobs if len(jobs) > 1 else jobs[0])
+
+    def _ready(self):
+        if not len(self.scheduler):
+            return False
+
+        workers = len(self.workers)
+        if self._in_flight < workers:
+            return True
+        if self._in_flight >= workers * self.PREFETCH:
+            return False
+
+        size = self.scheduler.peek()
+        return size is not None and size <= self.small_file
+
+    def record(self, job_id, transferred, result):
+        """Account progress reported from worker
+
+        Args:
+            job_id (str): Reported job's id
+            transferred (int): Bytes transferred since last report
+            result (int or Exception): Job result
+
+        """
+        with self._lock:
+            if result == 0:
+                self.transferred += transferred
+                return
+            self.queued -= 1
+
+            remaining = self._items.pop(job_id, None)
+            if remaining is not None:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    self._in_flight -= 1
+                    self._active = time.time()
+                    self._dispatchable.notify()
+
+            if result == 1:
+                self.transferred += transferred
+                self.finished += 1
+            else:
+                self.errored += 1
+
+    def sample(self):
+        """Return and reset counters since last sample
+
+        Returns:
+            tuple: Bytes transferred, jobs finished, jobs errored, and jobs
+                still in queue
+
+        """
+        with self._lock:
+            sample = (self.transferred, self.finished, self.errored,
+                      self.queued)
+            self.transferred = 0
+            self.finished = 0
+            self.errored = 0
+
+        return sample
+
+
+class AdaptiveController(object):
+    """Scale a worker group by measured throughput and error rate
+
+    Additive increase, multiplicative decrease. The group grows by one
+    worker while aggregate throughput keeps improving and there are more
+    queued jobs than workers. A step which did not pay off is reverted.
+    When the error rate is too high, the group shrinks by a quarter, since
+    that usually means the server is throttling connections.
+
+    Args:
+        group (WorkerGroup): Group to scale
+
+    """
+
+    ERROR_RATE = 0.1
+    IMPROVEMENT = 1.05
+    HOLD = 3  # Intervals to keep still after a reverted step
+
+    def __init__(self, group):
+        self.group = group
+        self._last_speed = None
+        self._last_step = 0
+        self._hold = 0
+
+    def step(self, elapsed):
+        """Measure since last step and resize group
+
+        Args:
+            elapsed (float): Seconds since last step
+
+        """
+        group = self.group
+        transferred, finished, errored, queued = group.sample()
+        speed = transferred / elapsed
+        size = group.size()
+
+        done = finished + errored
+        if done and errored / float(done) > self.ERROR_RATE:
+            group.resize(size - max(1, size // 4))
+            self._reset(hold=self.HOLD)
+            main_logger.debug("Site '%s': too many errors, %d workers."
+                              % (group.site, group.size()))
+            return
+
+        if not transferred and not queued:
+            self._reset()
+            return  # Idle
+
+        if self._hold:
+            self._hold -= 1
+
+        elif (self._last_step > 0 and
+              speed < self._last_speed * self.IMPROVEMENT):
+            # Grew but not faster, go back
+            group.resize(size - 1)
+            self._reset(hold=self.HOLD)
+
+        elif queued > size:
+            group.resize(size + 1)
+            self._last_step = group.size() - size
+
+        else:
+            self._last_step = 0
+
+        self._last_speed = speed
+
+    def _reset(self, hold=0):
+        self._last_speed = None
+        self._last_step = 0
+        self._hold = hold
+
+
+class WorkerPool(object):
+    """Worker groups of all sites
+
+    Groups are spawned on the first job of each site, sized by the site's
+    `.cfg` or the global default, see `config.default_workers`.
+
+    If a `manifest` is given, remote dirs are made and jobs with
+    `skip_exists` are checked against remote in bulk before being queued,
+    see `worker.RemoteManifest`. Jobs that can be skipped are reported as
+    completed with process id `None`, without ever reaching a worker.
+
+    Upload bandwidth is limited by a token bucket shared by all workers,
+    and another one per site, see `throttle`. Both can be changed at
+    runtime with `set_bandwidth`.
+
+    Workers of a site run on the site's backend, see `backends`. A backend
+    which `uploader` does not support, or which dependencies are missing,
+    falls back to processes.
+
+    Args:
+        uploader (type): `Uploader` class to spawn
+        pipe_out (multiprocessing.Queue): Progress report queue
+        manifest (type, optional): `RemoteManifest` class
+        workers (int, optional): Number of workers of every site, overrides
+            site's `.cfg` and the global default
+        bandwidth (str, optional): Global bandwidth `throttle.Schedule`,
+            defaults to `throttle.default_bandwidth()`
+
+    """
+
+    ADAPT_INTERVAL = 5  # Seconds between scaling and idle checks
+
+    def __init__(self,
+                 uploader,
+                 pipe_out,
+                 manifest=None,
+                 workers=None,
+                 bandwidth=None):
+        if bandwidth is None:
+            bandwidth = throttle.default_bandwidth()
+
+        self.pipe_out = pipe_out
+        self.groups = dict()
+        self.workers = dict()  # process id: worker
+        self.bucket = throttle.TokenBucket(throttle.Schedule(bandwidth))
+        self.buckets = dict()  # site: bucket
+        self.backends = dict()  # name: backend
+
+        self._uploader = uploader
+        self._workers = workers
+        self._manifest = manifest() if manifest is not None else None
+        self._preflight = None
+        self._ids = itertools.count()
+        self._controllers = list()
+        self._monitor = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        return next(self._ids)
+
+    def _spawn(self, backend, *args, **kwargs):
+        worker = backend.spawn(self._uploader, *args, **kwargs)
+        self.workers[worker._id] = worker
+        return worker
+
+    def _backend(self, name):
+        supported = getattr(self._uploader, "BACKENDS", (backends.PROCESS,))
+        if name not in supported:
+            main_logger.debug("%s does not support backend '%s', "
+                              "using processes." % (self._uploader.__name__,
+                                                    name))
+            name = backends.PROCESS
+
+        elif not backends.available(name):
+            main_logger.warning("Backend '%s' is not available, "
+                                "using processes." % name)
+            name = backends.PROCESS
+
+        backend = self.backends.get(name)
+        if backend is None:
+            backend = self.backends[name] = backends.get(name)
+        return backend
+
+    def group(self, site):
+        """Return worker group of site, spawn if not exists
+
+        Args:
+            site (str): Site name
+
+        Returns:
+            WorkerGroup: Or None if the pool has been stopped
+
+        """
+        with self._lock:
+            if self._stopped.is_set():
+                return None
+            if site in self.groups:
+                return self.groups[site]
+
+            try:
+                site_config = config.registry.get(site)
+            except Exception:
+                # Let the workers report the error per job
+                settings = dict(workers=config.default_workers(),
+                                adaptive=config.default_adaptive(),
+                                min_workers=1,
+                                max_workers=config.default_max_workers())
+                schedule = throttle.Schedule()
+                backend = backends.default_backend()
+            else:
+                settings = dict(workers=site_config.workers,
+                                adaptive=site_config.adaptive,
+                                min_workers=site_config.min_workers,
+                                max_workers=site_config.max_workers,
+                                batch_size=site_config.batch_size,
+                                small_file=site_config.small_file)
+                schedule = site_config.bandwidth
+                backend = site_config.backend
+
+            if self._workers:
+                settings["workers"] = self._workers
+                settings["min_workers"] = min(settings["min_workers"],
+                                              self._workers)
+                settings["max_workers"] = max(settings["max_workers"],
+                                              self._workers)
+
+            bucket = self._site_bucket(site)
+            bucket.schedule = schedule
+
+            backend = self._backend(backend)
+            group = WorkerGroup(site,
+                                uploader=functools.partial(self._spawn,
+                                                           backend),
+                                pipe_in=backend.queue(),
+                                pipe_out=self.pipe_out,
+                                next_id=self._next_id,
+                                throttle=throttle.Throttle([self.bucket,
+                                                            bucket]),
+                                idle_timeout=config.default_idle_timeout(),
+                                **settings)
+            self.groups[site] = group
+
+            if group.adaptive:
+                self._controllers.append(AdaptiveController(group))
+            if group.adaptive or group.idle_timeout:
+                self._start_monitor()
+
+            return group
+
+    def put(self, job, **options):
+        self.put_many([job], **options)
+
+    def put_many(self, jobs, key=None, project=None, priority=None):
+        """Queue jobs of one package
+
+        Args:
+            jobs (list): `JobItem`s
+            key (hashable, optional): Package identity, for changing its
+                priority later
+            project (str, optional): Project name, sites' bandwidth is
+                shared fairly between projects
+            priority (int, optional): Package priority, higher goes first
+
+        """
+        options = dict(key=key, project=project, priority=priority)
+
+        by_site = dict()
+        for job in jobs:
+            by_site.setdefault(job.site, list()).append(job)
+
+        for site, site_jobs in by_site.items():
+            if self._manifest is not None:
+                self._start_preflight()
+                self._preflight.put((site, site_jobs, options))
+            else:
+                self._put(site, site_jobs, options)
+
+    def set_priority(self, key, priority):
+        """Change priority of a package's jobs which are not yet uploading
+
+        Args:
+            key (hashable): Package identity, as given to `put_many`
+            priority (int): Higher goes first
+
+        """
+        for group in list(self.groups.values()):
+            group.set_priority(key, priority)
+
+    def _start_preflight(self):
+        if self._preflight is not None:
+            return
+
+        # Checked in one thread so jobs are queued in the order they came
+        self._preflight = _queue.Queue()
+
+        def preflight():
+            while True:
+                site, jobs, options = self._preflight.get()
+                if self._stopped.is_set():
+                    continue
+
+                # Queued by dir, as soon as each is prepared
+                for upload, existed in self._manifest.prepare(site, jobs):
+                    if self._stopped.is_set():
+                        break
+                    if existed:
+                        reports = [(job._id, job.content[2], 1)
+                                   for job in existed]
+                        self.pipe_out.put((None, reports))
+                    self._put(site, upload, options)
+
+        thread = threading.Thread(target=preflight, daemon=True)
+        thread.start()
+
+    def _put(self, site, jobs, options):
+        # No workers spawned for nothing, or after being stopped
+        if not jobs:
+            return
+        group = self.group(site)
+        if group is not None:
+            group.put_many(jobs, **options)
+
+    def record(self, job, transferred, result):
+        """Account progress reported from worker
+
+        Args:
+            job (JobItem): Reported job
+            transferred (int): Bytes transferred since last report
+            result (int or Exception): Job result
+
+        """
+        group = self.groups.get(job.site)
+        if group is not None:
+            group.record(job._id, transferred, result)
+
+    def set_bandwidth(self, rate, site=None):
+        """Override bandwidth limit, takes effect in all workers right away
+
+        Args:
+            rate (int or None): Bytes per second, 0 for unlimited, or None
+                to follow the configured schedule again
+            site (str, optional): Limit only this site's uploads, instead of
+                the total of all sites
+
+        """
+        if site is None:
+            self.bucket.set_rate(rate)
+        else:
+            with self._lock:
+                self._site_bucket(site).set_rate(rate)
+
+    def _site_bucket(self, site):
+        # May be made by `set_bandwidth` before the site's first job
+        if site not in self.buckets:
+            self.buckets[site] = throttle.TokenBucket(throttle.Schedule())
+        return self.buckets[site]
+
+    def is_uploading(self):
+        return any(w.consuming for w in list(self.workers.values()))
+
+    def stop(self, abort=False, timeout=None):
+        """Stop all workers and wait for them to exit
+
+        By default, workers finish the file they are on and then exit, jobs
+        still in queue are dropped. If they don't make it in `timeout`, or
+        if `abort`, the transfers in progress are interrupted, and their
+        partial files on remote are left to be resumed next time. Workers
+        that still hang after `ABORT_TIMEOUT` are terminated.
+
+        Args:
+            abort (bool, optional): Interrupt the transfers in progress
+            timeout (float, optional): Seconds to wait for workers to finish
+                current files, defaults to `DRAIN_TIMEOUT`
+
+        Returns:
+            bool: True if all workers exited by themselves
+
+        """
+        with self._lock:
+            self._stopped.set()
+            groups = list(self.groups.values())
+        for group in groups:
+            group.close()
+
+        workers = list(self.workers.values())  # Including retired ones
+
+        for worker in workers:
+            worker.stop(abort=abort)
+
+        if not abort:
+            timeout = DRAIN_TIMEOUT if timeout is None else timeout
+            workers = self._join(workers, timeout)
+            if workers:
+                main_logger.warning("%d workers still uploading after %ds, "
+                                    "aborting." % (len(workers), timeout))
+                for worker in workers:
+                    worker.stop(abort=True)
+
+        workers = self._join(workers, ABORT_TIMEOUT)
+        if workers:
+            main_logger.warning("%d workers not responding, terminating."
+                                % len(workers))
+            for worker in workers:
+                worker.terminate()
+            self._join(workers, 1)
+
+        return not workers
+
+    @staticmethod
+    def _join(workers, timeout):
+        """Wait for workers to exit, return the ones still alive"""
+        deadline = time.time() + timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+        return [worker for worker in workers if worker.is_alive()]
+
+    def _start_monitor(self):
+        if self._monitor is not None:
+            return
+
+        def monitor():
+            last = time.time()
+            while not self._stopped.wait(self.ADAPT_INTERVAL):
+                now = time.time()
+                for controller in list(self._controllers):
+                    controller.step(now - last)
+                last = now
+
+                for group in list(self.groups.values()):
+                    group.park()
+                # Forget the workers which have exited
+                with self._lock:
+                    for worker_id, worker in list(self.workers.items()):
+                        if not worker.is_alive():
+                            del self.workers[worker_id]
+
+        self._monitor = threading.Thread(target=monitor, daemon=True)
+        self._monitor.start()
@@ -0,0 +1,172 @@
+
+import heapq
+import itertools
+import threading
+
+
+FILE_COST = 1024 * 64  # Bytes charged per file on top of its size
+
+
+class _Package(object):
+
+    __slots__ = ("key", "project", "priority", "order", "jobs")
+
+    def __init__(self, key, project, priority, order):
+        self.key = key
+        self.project = project
+        self.priority = priority
+        self.order = order
+        self.jobs = list()  # Heap of (size, sequence, job)
+
+
+class Scheduler(object):
+    """Pending jobs of one site, in the order they should be uploaded
+
+    Jobs are held by package. The next package to take from is decided by:
+
+        1. Higher priority first
+        2. Fair share between projects, the project which has been served
+           the least bytes goes first
+        3. Package that was queued earlier first
+
+    Within a package, smaller files go first, so a package of a workfile
+    and a few caches has its workfile done in no time.
+
+    A project which had nothing pending starts from the least served
+    active project, instead of claiming the bandwidth it did not use.
+
+    """
+
+    def __init__(self):
+        self._packages = dict()  # key: _Package, the ones that have jobs
+        self._priorities = dict()  # key: priority
+        self._served = dict()  # project: bytes handed out
+        self._orders = itertools.count()
+        self._sequence = itertools.count()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def put(self, jobs, key=None, project=None, priority=None):
+        """Add jobs of one package
+
+        Args:
+            jobs (list): `JobItem`s
+            key (hashable, optional): Package identity, jobs of same key are
+                of the same package. Defaults to a new package.
+            project (str, optional): Project name, for fair sharing
+            priority (int, optional): Package priority, higher goes first,
+                defaults to package's current priority or 0
+
+        """
+        if not jobs:
+            return
+
+        with self._lock:
+            if key is None:
+                key = object()
+            if priority is not None:
+                self._priorities[key] = priority
+
+            package = self._packages.get(key)
+            if package is None:
+                self._activate(project)
+                package = _Package(key,
+                                   project,
+                                   self._priorities.get(key, 0),
+                                   next(self._orders))
+                self._packages[key] = package
+
+            for job in jobs:
+                heapq.heappush(package.jobs, (job.content[2],
+                                              next(self._sequence),
+                                              job))
+            self._count += len(jobs)
+
+    def set_priority(self, key, priority):
+        """Change package priority, takes effect on next `pop`
+
+        Args:
+            key (hashable): Package identity
+            priority (int): Higher goes first
+
+        """
+        with self._lock:
+            self._priorities[key] = priority
+            package = self._packages.get(key)
+            if package is not None:
+                package.priority = priority
+
+    def peek(self):
+        """Return size of the next job, or None if nothing pending"""
+        with self._lock:
+            package = self._next()
+            return None if package is None else package.jobs[0][0]
+
+    def pop(self, count=1, max_bytes=0, small_file=0):
+        """Take next job, or a batch of small files of the same package
+
+        Args:
+            count (int, optional): Max number of jobs to take
+            max_bytes (int, optional): Max total size of a batch
+            small_file (int, optional): Max size of a file to be batched
+
+        Returns:
+            list: `JobItem`s, empty if nothing pending
+
+        """
+        with self._lock:
+            package = self._next()
+            if package is None:
+                return list()
+
+            heap = package.jobs
+            jobs = [heapq.heappop(heap)[2]]
+            size = jobs[0].content[2]
+
+            if count > 1 and size <= small_file:
+                while (heap and len(jobs) < count and
+                       heap[0][0] <= small_file and
+                       size + heap[0][0] <= max_bytes):
+                    jobs.append(heapq.heappop(heap)[2])
+                    size += jobs[-1].content[2]
+
+            if not heap:
+                del self._packages[package.key]
+
+            served = self._served.get(package.project, 0)
+            self._served[package.project] = (served + size +
+                                             FILE_COST * len(jobs))
+            self._count -= len(jobs)
+
+            return jobs
+
+    def clear(self):
+        with self._lock:
+            self._packages.clear()
+            self._count = 0
+
+    def _next(self):
+        best = None
+        best_rank = None
+        served = self._served
+
+        for package in self._packages.values():
+            rank = (-package.priority,
+                    served.get(package.project, 0),
+                    package.order)
+            if best_rank is None or rank < best_rank:
+                best = package
+                best_rank = rank
+
+        return best
+
+    def _activate(self, project):
+        active = set(package.project for package in self._packages.values())
+        if project in active:
+            return
+
+        floor = min([self._served.get(p, 0) for p in active] or [0])
+        self._served[project] = max(self._served.get(project, 0), floor)
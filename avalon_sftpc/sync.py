@@ -0,0 +1,260 @@
+
+import os
+import weakref
+import hashlib
+import binascii
+import threading
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+SIZE = "size"  # Same size
+MTIME = "mtime"  # Same size and modification time
+CHECKSUM = "checksum"  # Same size and content
+
+MODES = (SIZE, MTIME, CHECKSUM)
+
+HASH_CHUNK = 1024**2
+EXEC_TIMEOUT = 60  # Seconds to wait for remote `md5sum`, plus hashing time
+HASH_RATE = 1024**2 * 50  # Bytes per second server hashes at, at least
+
+# SSH transports of which server does not run commands
+_no_exec = weakref.WeakSet()
+
+
+def default_mode():
+    """Return global sync policy for skipping existing files
+
+    Set by environment variable `AVALON_SFTPC_SYNC`, defaults to `MTIME`.
+
+    """
+    return os.getenv("AVALON_SFTPC_SYNC", MTIME)
+
+
+def default_cache_path():
+    """Return local digest cache file path
+
+    Set by environment variable `AVALON_SFTPC_DIGEST_CACHE`, defaults to
+    `~/.avalon-sftpc/digests.db`.
+
+    """
+    default = os.path.join(os.path.expanduser("~"),
+                           ".avalon-sftpc",
+                           "digests.db")
+    return os.getenv("AVALON_SFTPC_DIGEST_CACHE", default)
+
+
+def compare(mode, src, fsize, attr):
+    """Compare local file with remote file's attributes
+
+    Only cheap comparisons are done here, the content has to be compared
+    with `verify` if this returns None.
+
+    Args:
+        mode (str): Sync policy, one of `MODES`
+        src (str): Local file path
+        fsize (int): Local file size
+        attr (paramiko.SFTPAttributes): Remote file attributes
+
+    Returns:
+        bool or None: True if in sync, False if not, None if unknown
+
+    """
+    if attr.st_size != fsize:
+        return False
+    if mode == SIZE:
+        return True
+
+    # Remote mtime is in whole seconds
+    if attr.st_mtime == int(os.stat(src).st_mtime):
+        return True
+
+    return None if mode == CHECKSUM else False
+
+
+def verify(sftp, src, dst):
+    """Compare local file content with remote file, by MD5 digest
+
+    If they are the same, remote file's mtime is updated to local's, so the
+    next `compare` is settled by mtime without hashing again.
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        src (str): Local file path
+        dst (str): Remote file path
+
+    Returns:
+        bool: True if in sync
+
+    """
+    remote = remote_digest(sftp, dst, os.path.getsize(src))
+    if remote is None or remote != cache.digest(src):
+        return False
+
+    stat = os.stat(src)
+    sftp.utime(dst, (stat.st_atime, stat.st_mtime))
+    return True
+
+
+def is_synced(sftp, mode, src, dst, fsize, attr):
+    """Return True if remote file is in sync with local file
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        mode (str): Sync policy, one of `MODES`
+        src (str): Local file path
+        dst (str): Remote file path
+        fsize (int): Local file size
+        attr (paramiko.SFTPAttributes): Remote file attributes
+
+    """
+    synced = compare(mode, src, fsize, attr)
+    if synced is None:
+        synced = verify(sftp, src, dst)
+    return synced
+
+
+def remote_digest(sftp, path, size=0):
+    """Return remote file's MD5 hex digest, or None if not available
+
+    Try SFTP `check-file` extension first, then run `md5sum` on server.
+    If the server doesn't run it, it's not tried again on same connection.
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        path (str): Remote file path
+        size (int, optional): File size, for how long to wait for `md5sum`
+
+    """
+    try:
+        with sftp.open(path, "r") as file:
+            return binascii.hexlify(file.check("md5")).decode()
+    except IOError:
+        pass
+
+    # Accounts that are SFTP only may refuse to exec, or accept and never
+    # answer (e.g. `ForceCommand internal-sftp`)
+    import socket
+    from paramiko import SSHException
+
+    transport = sftp.get_channel().get_transport()
+    if transport in _no_exec:
+        return None
+
+    channel = None
+    try:
+        channel = transport.open_session()
+        channel.settimeout(EXEC_TIMEOUT + size / HASH_RATE)
+        channel.exec_command("md5sum " + quote(path))
+        channel.shutdown_write()
+        output = channel.makefile("r").read()
+        if channel.recv_exit_status() != 0:
+            return None
+    except (SSHException, socket.timeout, EOFError):
+        _no_exec.add(transport)
+        return None
+    finally:
+        if channel is not None:
+            channel.close()
+
+    return parse_md5sum(output)
+
+
+def parse_md5sum(output):
+    """Return MD5 hex digest from `md5sum` output, or None if invalid"""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    digest = output.split(" ", 1)[0].strip().lower()
+    return digest if len(digest) == 32 else None
+
+
+class DigestCache(object):
+    """Persistent local file digest cache
+
+    Digests are stored in SQLite, keyed by file path and stamped with the
+    file's size and mtime, so an unchanged file is never hashed twice. The
+    database file is shared by all upload processes, each opens its own
+    connection on first use.
+
+    Args:
+        path (str, optional): Database file path, defaults to
+            `default_cache_path()`
+
+    """
+
+    TIMEOUT = 30
+
+    def __init__(self, path=None):
+        self._path = path
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path or default_cache_path()
+
+    def _connect(self):
+        pid = os.getpid()
+        if self._db is None or self._pid != pid:
+            import sqlite3
+
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    pass  # Made by other process
+
+            db = sqlite3.connect(self.path,
+                                 timeout=self.TIMEOUT,
+                                 check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS digests ("
+                       "path TEXT PRIMARY KEY, "
+                       "size INTEGER, "
+                       "mtime REAL, "
+                       "md5 TEXT)")
+            db.commit()
+            self._db = db
+            self._pid = pid
+
+        return self._db
+
+    def digest(self, path):
+        """Return MD5 hex digest of local file, hash only if changed
+
+        Args:
+            path (str): Local file path
+
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT size, mtime, md5 FROM digests "
+                             "WHERE path = ?", (path,)).fetchone()
+
+        if row is not None and tuple(row[:2]) == (stat.st_size,
+                                                  stat.st_mtime):
+            return row[2]
+
+        md5 = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK), b""):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                       (path, stat.st_size, stat.st_mtime, digest))
+            db.commit()
+
+        return digest
+
+
+cache = DigestCache()
@@ -0,0 +1,257 @@
+
+import os
+import re
+import time
+import threading
+import multiprocessing
+
+
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+BURST = 0.5  # Seconds of idle bandwidth a bucket can save up
+LEASE_TIME = 0.02  # Seconds of bandwidth a process takes at a time
+MIN_LEASE = 1024 * 32
+MAX_LEASE = 1024**2 * 4
+UNLIMITED_LEASE = 1024**2 * 16  # Bytes between checks while unlimited
+SCHEDULE_CHECK = 10  # Seconds between time-of-day schedule lookups
+
+_TOKENS, _STAMP, _OVERRIDE = range(3)
+
+_rate_regex = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMG]?)B?(?:/S)?$")
+_range_regex = re.compile(r"^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})$")
+
+
+def parse_rate(value):
+    """Parse bandwidth like "512K", "20M" or "1.5G" into bytes per second
+
+    Units are binary, an optional trailing "B" or "B/s" is allowed. Zero
+    means unlimited.
+
+    Args:
+        value (str): Bandwidth
+
+    Returns:
+        int: Bytes per second, 0 if unlimited
+
+    """
+    match = _rate_regex.match(value.strip().upper())
+    if match is None:
+        raise ValueError("Invalid bandwidth: %r" % value)
+    number, unit = match.groups()
+    return int(float(number) * UNITS[unit])
+
+
+def default_bandwidth():
+    """Return global bandwidth limit of all uploads, as `Schedule` string
+
+    Set by environment variable `AVALON_SFTPC_BANDWIDTH`, unlimited if not
+    set.
+
+    """
+    return os.getenv("AVALON_SFTPC_BANDWIDTH", "")
+
+
+class Schedule(object):
+    """Bandwidth limit by local time of day
+
+    Parsed from comma separated entries, each one is either a bandwidth
+    which applies by default, or `HH:MM-HH:MM=<bandwidth>` which applies
+    within the time range. A range may wrap over midnight, and the first
+    matched range wins. For example, "20M, 20:00-08:00=0" is limited to
+    20 MB/s in the daytime and unlimited at night.
+
+    Args:
+        value (str): Schedule, empty for unlimited
+
+    """
+
+    def __init__(self, value=""):
+        self.value = value
+        self.default = 0
+        self.ranges = list()  # (start minute, end minute, rate)
+
+        for entry in value.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+
+            if "=" not in entry:
+                self.default = parse_rate(entry)
+                continue
+
+            period, rate = entry.split("=", 1)
+            match = _range_regex.match(period.strip())
+            if match is None:
+                raise ValueError("Invalid time range: %r" % period)
+
+            start_h, start_m, end_h, end_m = map(int, match.groups())
+            if start_h > 23 or end_h > 24 or start_m > 59 or end_m > 59:
+                raise ValueError("Invalid time range: %r" % period)
+
+            self.ranges.append((start_h * 60 + start_m,
+                                end_h * 60 + end_m,
+                                parse_rate(rate)))
+
+    def __repr__(self):
+        return "Schedule(%r)" % self.value
+
+    def is_unlimited(self):
+        return not self.default and not any(r[2] for r in self.ranges)
+
+    def rate(self, now=None):
+        """Return bytes per second at time `now`, 0 if unlimited
+
+        Args:
+            now (float, optional): Epoch seconds, defaults to current time
+
+        """
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+
+        for start, end, rate in self.ranges:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+
+        return self.default
+
+
+class TokenBucket(object):
+    """Token bucket shared by all upload processes
+
+    The token count lives in shared memory. Tokens can be overdrawn, the
+    taker is told how long to sleep until the debt is paid back, so one
+    lock round is all it costs to take tokens.
+
+    The rate follows `schedule` unless overridden by `set_rate`, which
+    takes effect in all processes right away.
+
+    Args:
+        schedule (Schedule): Bandwidth limit by time of day
+
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self._state = multiprocessing.RawArray("d", [0, time.time(), -1])
+        self._lock = multiprocessing.Lock()
+        # Per process cache of scheduled rate
+        self._scheduled = 0
+        self._next_check = 0
+
+    def set_rate(self, rate):
+        """Override the scheduled rate
+
+        Args:
+            rate (int or None): Bytes per second, 0 for unlimited, or None
+                to follow schedule again
+
+        """
+        self._state[_OVERRIDE] = -1 if rate is None else rate
+
+    def rate(self):
+        """Return current bytes per second, 0 if unlimited"""
+        override = self._state[_OVERRIDE]
+        if override >= 0:
+            return override
+
+        now = time.time()
+        if now >= self._next_check:
+            self._scheduled = self.schedule.rate(now)
+            self._next_check = now + SCHEDULE_CHECK
+
+        return self._scheduled
+
+    def take(self, size, rate):
+        """Take `size` tokens, return seconds to wait before sending
+
+        Args:
+            size (int): Number of bytes
+            rate (float): Current rate, from `rate()`
+
+        """
+        state = self._state
+        with self._lock:
+            now = time.time()
+            elapsed = max(0, now - state[_STAMP])
+            tokens = min(rate * BURST, state[_TOKENS] + elapsed * rate)
+            tokens -= size
+            state[_TOKENS] = tokens
+            state[_STAMP] = now
+
+        return -tokens / rate if tokens < 0 else 0
+
+
+class Throttle(object):
+    """Limit upload bandwidth of one process by a set of token buckets
+
+    Tokens are leased from the shared buckets in blocks of `LEASE_TIME`
+    worth of bandwidth and spent locally, so most `wait` calls are just a
+    subtraction. While unlimited, buckets are checked again every
+    `UNLIMITED_LEASE` bytes, so a limit set in the middle of a transfer
+    takes effect within a fraction of a second.
+
+    Args:
+        buckets (list): `TokenBucket`s to take from, e.g. the global one
+            and the site's
+
+    """
+
+    def __init__(self, buckets):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self._allowance = 0
+        self._lock = threading.Lock()  # Shared by segment upload threads
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def wait(self, size):
+        """Sleep until `size` bytes can be sent
+
+        Args:
+            size (int): Number of bytes about to be sent
+
+        """
+        delay = self.delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def delay(self, size):
+        """Take `size` bytes of bandwidth, return seconds to wait before
+        sending them, for callers which cannot block, e.g. in event loop
+
+        Args:
+            size (int): Number of bytes about to be sent
+
+        """
+        with self._lock:
+            self._allowance -= size
+            if self._allowance >= 0:
+                return 0
+            return self._lease()
+
+    def _lease(self):
+        limited = list()
+        for bucket in self.buckets:
+            rate = bucket.rate()
+            if rate > 0:
+                limited.append((bucket, rate))
+
+        if not limited:
+            self._allowance = UNLIMITED_LEASE
+            return 0
+
+        rate = min(rate for bucket, rate in limited)
+        lease = max(MIN_LEASE, min(MAX_LEASE, int(rate * LEASE_TIME)))
+        lease = max(lease, -self._allowance)
+        self._allowance += lease
+
+        return max(bucket.take(lease, rate) for bucket, rate in limited)
@@ -1,8 +1,11 @@
 
 import os
 import getpass
-import json
-from avalon import io, api, pipeline
+
+from . import jobfile
+
+# Modules from `avalon` are imported on use, so importing this module costs
+# nothing inside DCC App until a job is actually being exported.
 
 
 _DOC_CACHE = dict()
@@ -11,6 +14,7 @@ _DOC_CACHE = dict()
 def cparenthood(representation, flush=False):
     """Find all upstream documents with cache"""
     global _DOC_CACHE
+    from avalon import io
 
     if flush:
         _DOC_CACHE = dict()
@@ -81,6 +85,8 @@ class JobExporter(object):
     ]
 
     def __init__(self, remote_root, remote_user, site=None):
+        from avalon import api
+
         self.jobs = list()
         self.remote_root = remote_root
         self.remote_user = remote_user
@@ -90,22 +96,36 @@ class JobExporter(object):
         assert site, "SFTP site name not provided."
         self.site = site
 
-        self.available_loaders = api.discover(api.Loader)
+        self._loaders = None
+
+    @property
+    def available_loaders(self):
+        """Loaders are discovered on first use, only representation needs"""
+        if self._loaders is None:
+            from avalon import api
+            self._loaders = api.discover(api.Loader)
+        return self._loaders
 
-    def export(self, out=None):
-        """Write out JSON format job package file
+    def export(self, out=None, fmt=jobfile.JSON, compress=None):
+        """Write out job package file
 
         Args:
             out (str, optional): Output file path
+            fmt (str, optional): `jobfile.JSON` or `jobfile.JSONL`,
+                the latter is one package per line with common path
+                prefixes factored out, much smaller for big packages.
+                Defaults to `jobfile.JSON`.
+            compress (str, optional): `jobfile.GZIP` or `jobfile.ZSTD`,
+                defaults to None
 
         """
         if out is None:
+            from avalon import api
             host = api.registered_host()
             workfile = host.current_file() or "temp"
             out = os.path.abspath(workfile + ".sftp.job")
 
-        with open(out, "w") as file:
-            json.dump(self.jobs, file, indent=4)
+        jobfile.write(out, self.jobs, fmt=fmt, compress=compress)
 
         return out
 
@@ -118,6 +138,8 @@ class JobExporter(object):
             description (str): Line of job detail
 
         """
+        from avalon import api
+
         job = {
             "project": api.Session["AVALON_PROJECT"],
             "site": self.site,
@@ -134,6 +156,8 @@ class JobExporter(object):
             additional_jobs (list, optional): A list of callbacks
 
         """
+        from avalon import io, api
+
         # Add workfile
         session = api.Session
         host = api.registered_host()
@@ -188,6 +212,8 @@ class JobExporter(object):
             representation_id (str): Avalon representation Id
 
         """
+        from avalon import io, pipeline
+
         representation_id = io.ObjectId(representation_id)
         representation = io.find_one({"type": "representation",
                                       "_id": representation_id})
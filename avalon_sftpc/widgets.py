@@ -45,6 +45,9 @@ class JobWidget(QtWidgets.QWidget):
             view.setSortingEnabled(True)
             view.sortByColumn(1, QtCore.Qt.AscendingOrder)
             view.setAlternatingRowColors(True)
+            # Rows are all the same height, let view skip measuring each
+            # row on every `dataChanged`
+            view.setUniformRowHeights(True)
             view.setStyleSheet("""
                 QTreeView::item{
                     padding: 5px 1px;
@@ -70,6 +73,8 @@ class JobWidget(QtWidgets.QWidget):
         # Hide project and type by default for wider space
         upload_header.hideSection(0)
         upload_header.hideSection(1)
+        # Show `priority` before progress bar, so the bar stays stretched
+        upload_header.moveSection(5, 4)
         staging_header = staging_view.header()
         staging_header.hideSection(0)
         staging_header.hideSection(1)
@@ -78,6 +83,7 @@ class JobWidget(QtWidgets.QWidget):
         staging_view.setColumnWidth(3, 70)
         staging_view.setColumnWidth(4, 70)
         upload_view.setColumnWidth(2, 250)
+        upload_view.setColumnWidth(5, 60)
 
         self.staging_view = staging_view
         self.upload_view = upload_view
@@ -89,11 +95,22 @@ class JobWidget(QtWidgets.QWidget):
         show_project = QtWidgets.QCheckBox("Show Project")
         show_type = QtWidgets.QCheckBox("Show Type")
 
+        # Total bandwidth of all sites, "Auto" follows the configured
+        # schedule, see `throttle`
+        bandwidth = QtWidgets.QSpinBox()
+        bandwidth.setRange(0, 10000)
+        bandwidth.setSingleStep(5)
+        bandwidth.setSuffix(" MB/s")
+        bandwidth.setSpecialValueText("Auto")
+        bandwidth.setToolTip("Upload bandwidth limit")
+
         top_layout = QtWidgets.QHBoxLayout()
         top_layout.addWidget(show_project)
         top_layout.addSpacing(5)
         top_layout.addWidget(show_type)
         top_layout.addStretch()
+        top_layout.addWidget(QtWidgets.QLabel("Limit"))
+        top_layout.addWidget(bandwidth)
 
         upload_layout = QtWidgets.QVBoxLayout(upload_body)
         upload_layout.addLayout(top_layout)
@@ -120,6 +137,7 @@ class JobWidget(QtWidgets.QWidget):
 
         self.show_project = show_project
         self.show_type = show_type
+        self.bandwidth = bandwidth
         self.line_input = line_input
         self.send_btn = send_btn
         self.skip_exists = skip_exists
@@ -140,19 +158,14 @@ class JobWidget(QtWidgets.QWidget):
         send_btn.clicked.connect(self.stage)
         show_project.stateChanged.connect(self.on_show_project)
         show_type.stateChanged.connect(self.on_show_type)
+        bandwidth.valueChanged.connect(self.on_bandwidth_changed)
         self.model.staging.connect(self.on_staging)
         self.model.staged.connect(self.on_staged)
         self.model.canceling.connect(self.on_canceling)
         self.model.canceled.connect(self.on_canceled)
 
-        # Timer
-        #
-        self._update_timer = self.startTimer(100)
-
-    def timerEvent(self, event):
-        # (NOTE) We need this to force progress bar update
-        if event.timerId() == self._update_timer:
-            self.update()
+        # Ask after window shown
+        QtCore.QTimer.singleShot(0, self.offer_restore)
 
     def on_staging_menu(self, point):
         point_index = self.staging_view.indexAt(point)
@@ -196,6 +209,12 @@ class JobWidget(QtWidgets.QWidget):
 
         menu = QtWidgets.QMenu(self)
 
+        upload_first_action = QtWidgets.QAction("Upload First", menu)
+        upload_first_action.triggered.connect(self.act_upload_first)
+
+        upload_last_action = QtWidgets.QAction("Upload Last", menu)
+        upload_last_action.triggered.connect(self.act_upload_last)
+
         show_error_action = QtWidgets.QAction("Show Errors", menu)
         show_error_action.triggered.connect(self.act_show_error)
 
@@ -205,6 +224,9 @@ class JobWidget(QtWidgets.QWidget):
         requeue_all_action = QtWidgets.QAction("Re-upload Full Package", menu)
         requeue_all_action.triggered.connect(self.act_requeue_all)
 
+        menu.addAction(upload_first_action)
+        menu.addAction(upload_last_action)
+        menu.addSeparator()
         menu.addAction(show_error_action)
         menu.addAction(requeue_failed_action)
         menu.addAction(requeue_all_action)
@@ -215,8 +237,34 @@ class JobWidget(QtWidgets.QWidget):
         if not action:
             return
 
+    def offer_restore(self):
+        """Ask to continue packages that were not finished in last session
+        """
+        entries = self.model.unfinished()
+        if not entries:
+            return
+
+        files = sum(len(entry["data"]["files"]) for entry in entries)
+        message = ("%d packages (%d files) were not fully uploaded in last "
+                   "session.\nContinue uploading them ?" % (len(entries),
+                                                            files))
+        buttons = QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No
+        answer = QtWidgets.QMessageBox.question(self,
+                                                "Restore",
+                                                message,
+                                                buttons)
+
+        if answer == QtWidgets.QMessageBox.Yes:
+            self.model.restore(entries)
+            main_logger.info("Restored %d packages." % len(entries))
+        else:
+            self.model.forget(entries)
+
+    def on_bandwidth_changed(self, value):
+        self.model.set_bandwidth(value * 1024**2 if value else None)
+
     def on_quit(self):
-        self.model.stop()
+        self.model.stop(abort=True)
 
     def stage(self):
         job_file = self.line_input.text()
@@ -307,6 +355,28 @@ class JobWidget(QtWidgets.QWidget):
 
         return errored_packages
 
+    def _packages_from_selection(self):
+        model = self.model
+        proxy = self.upload_proxy
+        selection_model = self.upload_view.selectionModel()
+
+        rows = selection_model.selectedRows(column=0)
+        source_indices = [proxy.mapToSource(r) for r in rows]
+
+        return [model.data(index, model.ItemRole) for index in source_indices]
+
+    def act_upload_first(self):
+        """Upload selected packages before all the others
+        Upload Menu Action
+        """
+        self.model.prioritize(self._packages_from_selection(), first=True)
+
+    def act_upload_last(self):
+        """Upload selected packages after all the others
+        Upload Menu Action
+        """
+        self.model.prioritize(self._packages_from_selection(), first=False)
+
     def act_requeue_failed(self):
         errored_packages = self._errored_packages_from_selection()
         for package in errored_packages:
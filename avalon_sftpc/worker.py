@@ -1,20 +1,44 @@
 
 import os
+import time
+import signal
 import logging
-import contextlib
 import hashlib
 import threading
-import json
-from multiprocessing import Process
+from stat import S_ISDIR
+from multiprocessing import Process, Event
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from configparser import ConfigParser
+    from queue import Empty
 except ImportError:
-    from ConfigParser import ConfigParser
+    from Queue import Empty
 
 # dependencies
 import pysftp
 import paramiko
+from paramiko.sftp import (
+    int64,
+    CMD_OPEN,
+    CMD_WRITE,
+    CMD_FSETSTAT,
+    CMD_CLOSE,
+    CMD_EXTENDED,
+    CMD_MKDIR,
+    CMD_OPENDIR,
+    CMD_READDIR,
+    CMD_REMOVE,
+    CMD_STAT,
+    CMD_HANDLE,
+    CMD_STATUS,
+    SFTP_FLAG_WRITE,
+    SFTP_FLAG_CREATE,
+    SFTP_FLAG_TRUNC,
+)
+
+from . import backends, jobfile, sync
+from .config import registry
+from .throttle import Throttle
 
 
 main_logger = logging.getLogger("avalon-sftpc")
@@ -22,133 +46,1087 @@ main_logger = logging.getLogger("avalon-sftpc")
 
 _STOP = "STOP"
 
+RESUME_WINDOW = 1024 * 64
+
+PART_SUFFIX = ".part"
+SEGMENTS_SUFFIX = ".segments.part"
+
+
+class Aborted(Exception):
+    """Transfer interrupted by `Uploader.stop(abort=True)`"""
+
+
+def connect(config):
+    """Open an authenticated SFTP connection
+
+    Args:
+        config (SiteConfig): Site connection settings
+
+    Returns:
+        pysftp.Connection
+
+    """
+    cnopts = pysftp.CnOpts()
+    if config.hostkey is not None:
+        cnopts.hostkeys.add(config.host, "ssh-rsa", config.hostkey)
+    cnopts.ciphers = config.ciphers
+    cnopts.compression = config.compression
+
+    conn = pysftp.Connection(config.host,
+                             port=config.port,
+                             username=config.username,
+                             password=config.password,
+                             cnopts=cnopts)
+
+    # For the SFTP channel, which is opened on first use
+    transport = conn._transport
+    if config.window_size:
+        transport.default_window_size = config.window_size
+    if config.max_packet_size:
+        transport.default_max_packet_size = config.max_packet_size
+
+    return conn
+
+
+class ConnectionPool(object):
+    """Keep authenticated SFTP connections alive across jobs, per site
+
+    Each `Uploader` process owns one pool, so a package of thousands of
+    small files only pays the SSH handshake once per site instead of once
+    per file.
+
+    Args:
+        idle_timeout (float, optional): Seconds before an unused connection
+            gets closed, defaults to `IDLE_TIMEOUT`
+        check_interval (float, optional): Seconds a connection may sit
+            unused before it gets a round-trip health check on acquire,
+            defaults to `CHECK_INTERVAL`
+
+    """
+
+    IDLE_TIMEOUT = 300
+    CHECK_INTERVAL = 30
+
+    def __init__(self, idle_timeout=None, check_interval=None):
+        self.idle_timeout = idle_timeout or self.IDLE_TIMEOUT
+        self.check_interval = check_interval or self.CHECK_INTERVAL
+        # site name: [connection, last used, site config, known dirs]
+        self._connections = dict()
+
+    def acquire(self, config):
+        """Return a live connection to site, connect if needed
+
+        A new connection is made if the site's configuration has been
+        changed since the pooled one was opened.
+
+        Args:
+            config (SiteConfig): Site connection settings
+
+        Returns:
+            pysftp.Connection
+
+        """
+        self.prune()
+        now = time.time()
+        site = config.name
+
+        entry = self._connections.get(site)
+        if entry is not None:
+            conn, last_used, opened_with, _ = entry
+            deep = now - last_used > self.check_interval
+            if opened_with is not config:
+                self.discard(site)
+            elif self.is_alive(conn, deep=deep):
+                entry[1] = now
+                return conn
+            else:
+                main_logger.debug("Connection to '%s' is broken, "
+                                  "reconnecting." % site)
+                self.discard(site)
+
+        conn = connect(config)
+        self._connections[site] = [conn, now, config, set()]
+
+        return conn
+
+    def known_dirs(self, site):
+        """Return the set of remote dirs known to exist on site's connection
+
+        Args:
+            site (str): Site name, must have been acquired
+
+        """
+        return self._connections[site][3]
+
+    def discard(self, site):
+        """Close and forget the connection of site"""
+        entry = self._connections.pop(site, None)
+        if entry is not None:
+            self._close(entry[0])
+
+    def prune(self):
+        """Close connections which have been idle for too long"""
+        now = time.time()
+        for site, entry in list(self._connections.items()):
+            last_used = entry[1]
+            if now - last_used > self.idle_timeout:
+                self.discard(site)
+
+    def close(self):
+        """Close all connections"""
+        for site in list(self._connections):
+            self.discard(site)
+
+    @staticmethod
+    def is_alive(conn, deep=False):
+        """Health check
+
+        Args:
+            conn (pysftp.Connection): Connection to check
+            deep (bool, optional): Also do a round-trip to server,
+                defaults to False
+
+        """
+        try:
+            channel = conn.sftp_client.get_channel()
+            if channel.closed or not channel.get_transport().is_active():
+                return False
+            if deep:
+                conn.sftp_client.normalize(".")
+        except Exception:
+            return False
+
+        return True
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            # Should be safe to ignore, the connection is gone anyway
+            pass
+
+
+class ProgressReporter(object):
+    """Throttle and batch progress reports from one worker
+
+    Reports of every job are coalesced, only the latest state of each job
+    is kept, and sent as one message at most every `INTERVAL` seconds, so
+    a big file does not flood `pipe_out` with a message per write chunk.
+
+    A message is a tuple of worker's process id and a list of
+    `(job id, transferred, result)` reports.
+
+    Final or error state is never dropped, it's sent at next `flush`, which
+    happens on interval or whenever the worker runs out of jobs.
+
+    Args:
+        pipe_out (multiprocessing.Queue): Progress report queue
+        process_id (int): Worker's process id
+
+    """
+
+    INTERVAL = 0.1
+
+    def __init__(self, pipe_out, process_id):
+        self.pipe_out = pipe_out
+        self._id = process_id
+        self._reports = dict()  # job id: (transferred, result)
+        self._flushed = time.time()
+        self.messages = 0  # For measurement
+
+    def progress(self, job_id, transferred):
+        """Report job in progress"""
+        self._reports[job_id] = (transferred, 0)
+        if time.time() - self._flushed >= self.INTERVAL:
+            self.flush()
+
+    def finish(self, job_id, transferred, result):
+        """Report job completed (result is 1) or failed (result is error)
+        """
+        self._reports[job_id] = (transferred, result)
+        if time.time() - self._flushed >= self.INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Send all pending reports in one message"""
+        self._flushed = time.time()
+        if not self._reports:
+            return
+
+        reports = [(job_id, transferred, result)
+                   for job_id, (transferred, result)
+                   in self._reports.items()]
+        self._reports.clear()
+
+        self.pipe_out.put((self._id, reports))
+        self.messages += 1
+
+
+class RemoteManifest(object):
+    """Prepare remote for jobs in bulk, before they are queued
+
+    Every distinct remote dir of the jobs is visited once, in sorted order.
+    It's listed if there are jobs to check for skipping, so existing files
+    can be matched without one `stat` per file from each worker, and it's
+    made if not exists, so workers rarely need to.
+
+    Dirs are listed with pipelined requests, `LIST_WINDOW` at a time, and
+    jobs are handed out by dir as soon as it's done, so workers start on
+    them while the rest are still being listed.
+
+    """
+
+    LIST_WINDOW = 64
+
+    def __init__(self):
+        self.pool = ConnectionPool()
+
+    def prepare(self, site, jobs):
+        """Make remote dirs and sort out jobs which files already exist
+
+        Jobs which have been checked get `skip_exists` turned off, so the
+        workers won't check them again.
+
+        Args:
+            site (str): Site name
+            jobs (list): `JobItem`s of the site
+
+        Yields:
+            tuple: Jobs to upload and jobs to skip, of one remote dir or
+                the ones left to workers to check
+
+        """
+        try:
+            site_config = registry.get(site)
+            conn = self.pool.acquire(site_config)
+        except Exception:
+            # Let the workers check and report the error per job
+            yield jobs, []
+            return
+
+        sftp = conn.sftp_client
+        known_dirs = self.pool.known_dirs(site)
+
+        by_dir = dict()
+        for job in jobs:
+            by_dir.setdefault(os.path.dirname(job.content[1]),
+                              list()).append(job)
+
+        checking = [remote_dir for remote_dir, dir_jobs
+                    in sorted(by_dir.items())
+                    if any(job.skip_exists for job in dir_jobs)]
+
+        try:
+            # Nothing to check, just need the dirs
+            unchecked = sorted(set(by_dir) - set(checking))
+            _makedirs_many(sftp, unchecked, known_dirs)
+            for remote_dir in unchecked:
+                yield by_dir.pop(remote_dir), []
+
+            missing = list()
+            for remote_dir, entries in _listdirs(sftp,
+                                                 checking,
+                                                 self.LIST_WINDOW):
+                if entries is None:
+                    missing.append(remote_dir)
+                    continue
+
+                _learn_dirs(remote_dir, entries, known_dirs)
+                yield self._sort(site_config, by_dir.pop(remote_dir), entries)
+
+            # Nothing in these to skip
+            _makedirs_many(sftp, missing, known_dirs)
+            for remote_dir in missing:
+                yield self._sort(site_config, by_dir.pop(remote_dir), [])
+
+        except Exception:
+            # Connection lost, leave the rest to workers
+            self.pool.discard(site)
+            rest = [job for dir_jobs in by_dir.values() for job in dir_jobs]
+            if rest:
+                yield rest, []
+
+    @staticmethod
+    def _sort(site_config, jobs, entries):
+        """Return jobs to upload and jobs to skip, by remote dir entries"""
+        index = dict((entry.filename, entry) for entry in entries)
+
+        upload = list()
+        existed = list()
+        for job in jobs:
+            if not job.skip_exists:
+                upload.append(job)
+                continue
+
+            src, dst, fsize = job.content
+            entry = index.get(os.path.basename(dst))
+            if entry is None:
+                job.skip_exists = False
+                upload.append(job)
+                continue
+
+            try:
+                synced = sync.compare(site_config.sync, src, fsize, entry)
+            except OSError:
+                synced = False  # Let the worker report
+
+            if synced:
+                existed.append(job)
+                continue
+            if synced is not None:
+                # Otherwise contents need to be compared by worker
+                job.skip_exists = False
+            upload.append(job)
+
+        return upload, existed
+
+
+def _learn_dirs(remote_dir, entries, known):
+    """Add a listed dir, its parents and its sub dirs to known dirs"""
+    for entry in entries:
+        if S_ISDIR(entry.st_mode or 0):
+            known.add(remote_dir.rstrip("/") + "/" + entry.filename)
+
+    path = remote_dir
+    while path and path not in known:
+        known.add(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+
+def _makedirs_many(sftp, dirs, known):
+    """Make remote dirs and their parents with pipelined requests
+
+    Dirs are made level by level, parents first, each level in one round
+    trip. Ones known to exist are skipped, the rest are made without
+    checking, failing on existing ones is ignored.
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        dirs (list): Remote dir paths
+        known (set): Dirs known to exist, updated in place
+
+    """
+    by_depth = dict()
+    for remote_dir in dirs:
+        path = remote_dir
+        while path and path not in known:
+            by_depth.setdefault(path.count("/"), set()).add(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    pipe = _Pipeline(sftp)
+    for depth in sorted(by_depth):
+        making = list()
+        for path in sorted(by_depth[depth]):
+            attr = paramiko.SFTPAttributes()
+            attr.st_mode = 0o777
+            making.append(pipe.send(CMD_MKDIR, path, attr))
+
+        for num in making:
+            try:
+                pipe.reply(num)
+            except IOError:
+                # Exists, or made by other worker just now. If it really
+                # failed, the upload will tell.
+                pass
+
+        known.update(by_depth[depth])
+
+
+def _listdirs(sftp, dirs, window):
+    """Yield each remote dir with its entries, listed with pipelined requests
+
+    Each step of listing (open, read, close) is sent for up to `window` dirs
+    together, so listing them costs a few round trips instead of a few per
+    dir. Dirs are yielded as they are done, not in given order.
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        dirs (list): Remote dir paths
+        window (int): Max number of dirs being listed at a time
+
+    Yields:
+        tuple: Dir path and list of `paramiko.SFTPAttributes`, or None if
+            the dir can't be listed (e.g. not exists)
 
-def get_site(site_name):
     """
+    pipe = _Pipeline(sftp)
+
+    for start in range(0, len(dirs), window):
+        handles = dict()
+        opening = [(remote_dir, pipe.send(CMD_OPENDIR, remote_dir))
+                   for remote_dir in dirs[start:start + window]]
+        for remote_dir, num in opening:
+            try:
+                t, msg = pipe.reply(num)
+            except IOError:
+                yield remote_dir, None
+                continue
+            handles[remote_dir] = msg.get_binary()
+
+        entries = dict((remote_dir, list()) for remote_dir in handles)
+        closing = list()
+        while handles:
+            reading = [(remote_dir, pipe.send(CMD_READDIR, handle))
+                       for remote_dir, handle in handles.items()]
+            for remote_dir, num in reading:
+                try:
+                    t, msg = pipe.reply(num)
+                except (EOFError, IOError) as error:
+                    closing.append(pipe.send(CMD_CLOSE,
+                                             handles.pop(remote_dir)))
+                    listed = entries.pop(remote_dir)
+                    yield remote_dir, (listed if isinstance(error, EOFError)
+                                       else None)
+                    continue
+
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attr = paramiko.SFTPAttributes._from_msg(msg,
+                                                             filename,
+                                                             longname)
+                    if filename not in (".", ".."):
+                        entries[remote_dir].append(attr)
+
+        for num in closing:
+            try:
+                pipe.reply(num)
+            except IOError:
+                pass
+
+
+class _Pipeline(object):
+    """Send SFTP requests without waiting for each reply
+
+    Built on the same `SFTPClient` internals which `SFTPFile` uses for its
+    pipelined writes, this object collects replies by request number.
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+
     """
-    default_sites = os.path.dirname(__file__) + "/sites"
-    sites = os.getenv("AVALON_SFTPC_SITES", default_sites)
 
-    site_cfg = sites + "/%s.cfg" % site_name
-    if not os.path.isfile(site_cfg):
-        raise Exception("Site '%s' configuration file not found: %s"
-                        "" % (site_name, site_cfg))
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self._replies = dict()
+
+    def send(self, t, *args):
+        """Send request, return request number"""
+        return self.sftp._async_request(self, t, *args)
+
+    def reply(self, num):
+        """Wait for reply of request
 
-    # Read settings from a configuration file
-    parser = ConfigParser()
-    parser.read(site_cfg)
-    get = (lambda key: parser.get("avalon-sftp", key, fallback=""))
+        Raises:
+            IOError: If server replies error status
 
-    return {
-        "host": get("host"),
-        "port": int(get("port") or 22),
-        "username": get("username"),
-        "password": get("password"),
-        "hostkey": b"".join(get("hostkey").encode().split()),
-    }
+        """
+        while num not in self._replies:
+            self.sftp._read_response()
+
+        t, msg = self._replies.pop(num)
+        if t == CMD_STATUS:
+            self.sftp._convert_status(msg)
+
+        return t, msg
+
+    def _async_response(self, t, msg, num):
+        # Called by `SFTPClient._read_response`
+        self._replies[num] = (t, msg)
 
 
 class Uploader(Process):
 
-    def __init__(self, pipe_in, pipe_out, process_id):
+    POLL_INTERVAL = 1
+    # Backends this class can run on, see `backends`
+    BACKENDS = (backends.PROCESS, backends.THREAD, backends.ASYNCIO)
+
+    def __init__(self, pipe_in, pipe_out, process_id, throttle=None):
         super(Uploader, self).__init__()
         self.pipe_in = pipe_in
         self.pipe_out = pipe_out
         self._id = process_id
-        self.consuming = False
+        self.throttle = throttle or Throttle([])
+        self.retired = Event()
+        self.aborted = Event()
+        self.busy = Event()  # Set by worker process while on a job
+        self.pool = None
+        self.reporter = None
 
-    def stop(self):
-        self.pipe_in.put(_STOP)
+    @property
+    def consuming(self):
+        return self.busy.is_set()
 
-    @contextlib.contextmanager
-    def _connection(self, host, port, username, password, hostkey):
-        cnopts = None
-        if hostkey:
-            hostkey = paramiko.py3compat.decodebytes(hostkey)
-            sshkey = paramiko.RSAKey(data=hostkey)
-            cnopts = pysftp.CnOpts()
-            cnopts.hostkeys.add(host, "ssh-rsa", sshkey)
+    def stop(self, abort=False):
+        """Exit after current job, or interrupt it if `abort`
 
-        try:
-            conn = pysftp.Connection(host,
-                                     port=port,
-                                     username=username,
-                                     password=password,
-                                     cnopts=cnopts)
-            yield conn
+        Jobs still in queue are left. An interrupted transfer's partial file
+        on remote is kept to be resumed, unless it was segmented.
 
-        except Exception as error:
-            # Mock a connection object for exit
-            conn = type("MockConn", (object,), {"close": lambda: None})
-            yield error
+        """
+        self.retired.set()
+        if abort:
+            self.aborted.set()
+        self.pipe_in.put(_STOP)  # Wake up if waiting for job
 
-        finally:
-            conn.close()
+    def retire(self):
+        """Exit after current job, leave the rest of queue to other workers
+        """
+        self.retired.set()
 
     # Let the jobs able to keep coming
     def run(self):
-        while True:
-            job = self.pipe_in.get()
+        # Ctrl+C is for parent process, which stops workers, see `stop`
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-            if job == _STOP:
-                break
+        self.pool = ConnectionPool()
+        self.reporter = ProgressReporter(self.pipe_out, self._id)
+        try:
+            while not self.retired.is_set():
+                try:
+                    job = self.pipe_in.get_nowait()
+                except Empty:
+                    # Running out of jobs, deliver what we have done
+                    self.reporter.flush()
+                    try:
+                        job = self.pipe_in.get(timeout=self.POLL_INTERVAL)
+                    except Empty:
+                        # Nothing to do, drop idle connections meanwhile
+                        self.pool.prune()
+                        continue
 
-            src, dst, fsize = job.content
+                if job == _STOP:
+                    break
+
+                self.busy.set()
+                try:
+                    if isinstance(job, list):
+                        self._process_batch(job)
+                    else:
+                        self._process(job)
+                finally:
+                    self.busy.clear()
+        finally:
+            self.reporter.flush()
+            self.pool.close()
+
+    def _process(self, job):
+        src, dst, fsize = job.content
+        reporter = self.reporter
+
+        def callback(transferred, to_be_transferred):
+            """Update progress"""
+            if self.aborted.is_set():
+                raise Aborted("Upload aborted.")
+            reporter.progress(job._id, transferred)
 
-            def callback(transferred, to_be_transferred):
-                """Update progress"""
-                result = transferred == to_be_transferred
-                self.pipe_out.put((job._id, transferred, result, self._id))
+        try:
+            site_config = registry.get(job.site)
+        except Exception as error:
+            reporter.finish(job._id, fsize, error)
+            return
 
+        # Retry once on a fresh connection if the pooled one was broken
+        # in the middle of the transfer, e.g. dropped by server or network.
+        for retry in (False, True):
             try:
-                site_config = get_site(job.site)
+                conn = self.pool.acquire(site_config)
             except Exception as error:
-                self.pipe_out.put((job._id, fsize, error, self._id))
-                continue
+                # Connection error occurred
+                reporter.finish(job._id, fsize, error)
+                return
 
-            with self._connection(**site_config) as conn:
-                if not isinstance(conn, pysftp.Connection):
-                    # Connection error occurred
-                    error = conn
-                    self.pipe_out.put((job._id, fsize, error, self._id))
+            try:
+                self._upload(conn, job, callback, site_config)
+            except Exception as error:
+                if (not retry and not isinstance(error, Aborted) and
+                        not self.pool.is_alive(conn)):
+                    self.pool.discard(job.site)
                     continue
+                # When error happens, return file size as all transferred,
+                # so the progress and status can be visualized properly.
+                reporter.finish(job._id, fsize, error)
+            else:
+                reporter.finish(job._id, fsize, 1)
+            return
 
-                if job.skip_exists:
-                    try:
-                        stat = conn.sftp_client.stat(dst)
-                    except IOError:
-                        pass  # Not exists, do upload!
-                    else:
-                        if fsize == stat.st_size:
-                            self.pipe_out.put((job._id, fsize, 1, self._id))
-                            continue
+    def _process_batch(self, jobs):
+        """Upload a batch of small files of the same site"""
+        reporter = self.reporter
+        site = jobs[0].site
+
+        def fail(error):
+            for job in jobs:
+                reporter.finish(job._id, job.content[2], error)
+
+        if self.aborted.is_set():
+            fail(Aborted("Upload aborted."))
+            return
+
+        try:
+            site_config = registry.get(site)
+        except Exception as error:
+            fail(error)
+            return
+
+        for retry in (False, True):
+            try:
+                conn = self.pool.acquire(site_config)
+            except Exception as error:
+                fail(error)
+                return
+
+            try:
+                results = self._upload_batch(conn, jobs, site_config)
+            except Exception as error:
+                if not retry and not self.pool.is_alive(conn):
+                    self.pool.discard(site)
+                    continue
+                fail(error)
+            else:
+                for job, result in zip(jobs, results):
+                    reporter.finish(job._id, job.content[2], result)
+            return
+
+    def _upload_batch(self, conn, jobs, site_config):
+        """Upload small files with all their requests in flight together
+
+        Instead of open, write, close and set mtime one file after another,
+        each step's requests of all files are sent without waiting for
+        replies, so the whole batch costs a few round trips instead of a
+        few per file.
+
+        Like `_put`, files are written with `PART_SUFFIX` and renamed to
+        destination once completed, so a failed batch never leaves an
+        existing remote file truncated.
+
+        Returns:
+            list: Result of each job, 1 or error
+
+        """
+        pipe = _Pipeline(conn.sftp_client)
+        results = [None] * len(jobs)
+
+        # Skip exists
+        stats = [(i, pipe.send(CMD_STAT, job.content[1]))
+                 for i, job in enumerate(jobs) if job.skip_exists]
+        for i, num in stats:
+            try:
+                t, msg = pipe.reply(num)
+            except IOError:
+                continue  # Not exists, do upload!
+            stat = paramiko.SFTPAttributes._from_msg(msg)
+            src, dst, fsize = jobs[i].content
+            try:
+                if sync.is_synced(conn.sftp_client,
+                                  site_config.sync,
+                                  src, dst, fsize, stat):
+                    results[i] = 1
+            except Exception as error:
+                # Can't tell, upload again
+                main_logger.debug("Verify '%s' failed: %s" % (dst, error))
+
+        todo = [i for i, result in enumerate(results) if result is None]
 
-                        # (TODO) Compare mtime
-                        #   Currently we already uploading files without
-                        #   preserving file's modification time, so maybe
-                        #   next time. :)
+        known_dirs = self.pool.known_dirs(jobs[0].site)
+        for remote_dir in sorted(set(os.path.dirname(jobs[i].content[1])
+                                     for i in todo)):
+            _makedirs(conn.sftp_client, remote_dir, known_dirs)
 
-                remote_dir = os.path.dirname(dst)
+        # Open
+        flags = SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC
+        opens = [(i, pipe.send(CMD_OPEN,
+                               jobs[i].content[1] + PART_SUFFIX,
+                               flags,
+                               paramiko.SFTPAttributes()))
+                 for i in todo]
+        handles = list()
+        for i, num in opens:
+            try:
+                t, msg = pipe.reply(num)
+                if t != CMD_HANDLE:
+                    raise paramiko.SFTPError("Expected handle")
+            except Exception as error:
+                results[i] = error
+            else:
+                handles.append((i, msg.get_binary()))
+
+        # Write, preserve mtime and close
+        chunk_size = site_config.chunk_size
+        requests = list()
+        for i, handle in handles:
+            src, dst, fsize = jobs[i].content
+            nums = list()
+            try:
+                with open(src, "rb", site_config.buffer_size) as file:
+                    offset = 0
+                    while True:
+                        data = file.read(chunk_size)
+                        if not data:
+                            break
+                        self.throttle.wait(len(data))
+                        nums.append(pipe.send(CMD_WRITE,
+                                              handle,
+                                              int64(offset),
+                                              data))
+                        offset += len(data)
+
+                if offset != fsize:
+                    raise IOError("Size mismatch in upload! %d != %d"
+                                  % (offset, fsize))
 
+                stat = os.stat(src)
+                attr = paramiko.SFTPAttributes()
+                attr.st_atime, attr.st_mtime = stat.st_atime, stat.st_mtime
+                nums.append(pipe.send(CMD_FSETSTAT, handle, attr))
+
+            except Exception as error:
+                results[i] = error
+
+            nums.append(pipe.send(CMD_CLOSE, handle))
+            requests.append((i, nums))
+
+        for i, nums in requests:
+            for num in nums:
                 try:
-                    conn.makedirs(remote_dir)
-                except Exception:
-                    # Should be safe to ignore this error
-                    pass
+                    pipe.reply(num)
+                except Exception as error:
+                    if results[i] is None:
+                        results[i] = error
+
+        # Rename completed ones to destination, remove the failed ones
+        renames = list()
+        removes = list()
+        for i, _ in handles:
+            part = jobs[i].content[1] + PART_SUFFIX
+            if results[i] is None:
+                renames.append((i, pipe.send(CMD_EXTENDED,
+                                             "posix-rename@openssh.com",
+                                             part,
+                                             jobs[i].content[1])))
+            else:
+                removes.append(pipe.send(CMD_REMOVE, part))
 
+        for i, num in renames:
+            try:
+                pipe.reply(num)
+            except IOError:
+                # No atomic overwrite on this server
                 try:
-                    conn.put(src,
-                             dst,
-                             preserve_mtime=True,
-                             callback=callback)
+                    _rename(conn.sftp_client,
+                            jobs[i].content[1] + PART_SUFFIX,
+                            jobs[i].content[1])
                 except Exception as error:
-                    # When error happens, return file size as all transferred,
-                    # so the progress and status can be visualized properly.
-                    self.pipe_out.put((job._id, fsize, error, self._id))
+                    results[i] = error
+                    continue
+            results[i] = 1
+
+        for num in removes:
+            try:
+                pipe.reply(num)
+            except IOError:
+                pass
+
+        return results
+
+    def _upload(self, conn, job, callback, site_config):
+        """Upload one job's file through `conn`, or skip if exists"""
+        src, dst, fsize = job.content
+
+        if job.skip_exists:
+            try:
+                stat = conn.sftp_client.stat(dst)
+            except IOError:
+                pass  # Not exists, do upload!
+            else:
+                if sync.is_synced(conn.sftp_client,
+                                  site_config.sync,
+                                  src, dst, fsize, stat):
+                    return
+
+        _makedirs(conn.sftp_client,
+                  os.path.dirname(dst),
+                  self.pool.known_dirs(job.site))
+
+        segments = site_config.segments
+        segmented = segments > 1 and 0 < site_config.segment_threshold <= fsize
+
+        try:
+            if segmented:
+                self._upload_segmented(conn, job, callback, site_config)
+            else:
+                self._put(conn, job, callback, site_config)
+
+        except Aborted:
+            # Partial file is kept for resuming, except the segmented one,
+            # which may have holes and always starts over
+            if segmented:
+                try:
+                    conn.sftp_client.remove(dst + SEGMENTS_SUFFIX)
+                except IOError:
+                    pass
+            raise
+
+    def _put(self, conn, job, callback, site_config):
+        """Upload one file into a partial file, resume if possible
+
+        The file is written to `dst` with `PART_SUFFIX` first, and renamed
+        to `dst` once completed. If a partial file from previous attempt
+        exists, and its tail matches the local file, the upload continues
+        from where it was left.
+
+        """
+        src, dst, fsize = job.content
+        sftp = conn.sftp_client
+        part = dst + PART_SUFFIX
+
+        offset = _resume_offset(sftp, src, part, fsize)
+        if offset:
+            main_logger.debug("Resuming '%s' from %d." % (dst, offset))
+
+        chunk_size = site_config.chunk_size
+        with open(src, "rb", site_config.buffer_size) as local, \
+                sftp.open(part, "r+" if offset else "wb") as remote:
+            _tune(remote, site_config)
+            local.seek(offset)
+            remote.seek(offset)
+
+            transferred = offset
+            callback(transferred, fsize)
+
+            while True:
+                data = local.read(chunk_size)
+                if not data:
+                    break
+                self.throttle.wait(len(data))
+                remote.write(data)
+                transferred += len(data)
+                callback(transferred, fsize)
+
+        _complete(sftp, src, part, dst, fsize)
+
+    def _upload_segmented(self, conn, job, callback, site_config):
+        """Upload one big file in byte ranges concurrently
+
+        Each range is written with offset writes through its own connection,
+        the first one reuses `conn`. Then the remote file size is verified.
+
+        """
+        src, dst, fsize = job.content
+        segments = site_config.segments
+        chunk_size = site_config.chunk_size
+        length = -(-fsize // segments)  # Ceiling
+        ranges = [(offset, min(length, fsize - offset))
+                  for offset in range(0, fsize, length)]
+
+        # Concurrent range writes may leave holes in an unfinished file,
+        # which cannot be resumed, so it's written into its own partial
+        # file and always starts over.
+        part = dst + SEGMENTS_SUFFIX
+        conn.sftp_client.open(part, "wb").close()
+
+        lock = threading.Lock()
+        transferred = [0]
+        errors = list()
+
+        def write(segment_conn, offset, size):
+            try:
+                with open(src, "rb", site_config.buffer_size) as local, \
+                        segment_conn.sftp_client.open(part, "r+") as remote:
+                    _tune(remote, site_config)
+                    local.seek(offset)
+                    remote.seek(offset)
+
+                    remaining = size
+                    while remaining and not errors:
+                        data = local.read(min(chunk_size, remaining))
+                        if not data:
+                            raise IOError("Local file has been truncated.")
+                        self.throttle.wait(len(data))
+                        remote.write(data)
+                        remaining -= len(data)
+
+                        with lock:
+                            transferred[0] += len(data)
+                            callback(transferred[0], fsize)
+
+            except Exception as error:
+                errors.append(error)
+
+        extra_conns = list()
+        threads = list()
+        try:
+            for index, (offset, size) in enumerate(ranges):
+                if index == 0:
+                    segment_conn = conn
+                else:
+                    segment_conn = connect(site_config)
+                    extra_conns.append(segment_conn)
+
+                thread = threading.Thread(target=write,
+                                          args=(segment_conn, offset, size),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        finally:
+            for thread in threads:
+                thread.join()
+            for segment_conn in extra_conns:
+                ConnectionPool._close(segment_conn)
+
+        if errors:
+            raise errors[0]
+
+        _complete(conn.sftp_client, src, part, dst, fsize)
+
+
+def _tune(remote, site_config):
+    """Apply site's write settings to an opened remote file
+
+    Args:
+        remote (paramiko.SFTPFile): File opened for writing
+        site_config (SiteConfig): Site settings
+
+    """
+    remote.set_pipelined(site_config.pipelined)
+    # Otherwise writes are split into requests of the default size
+    remote.MAX_REQUEST_SIZE = site_config.chunk_size
+
+
+def _makedirs(sftp, remote_dir, known):
+    """Make remote dir and its parents, skip the ones known to exist
+
+    Args:
+        sftp (paramiko.SFTPClient): SFTP session
+        remote_dir (str): Remote dir path
+        known (set): Dirs known to exist, updated in place
+
+    """
+    missing = list()
+    path = remote_dir
+    while path and path not in known:
+        try:
+            sftp.stat(path)
+        except IOError:
+            missing.append(path)
+        except Exception:
+            return  # Let the upload raise the connection error
+        else:
+            known.add(path)
+            break
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    for path in reversed(missing):
+        try:
+            sftp.mkdir(path)
+        except IOError:
+            # Should be safe to ignore this error, the dir may have been
+            # made by other worker just now.
+            pass
+        known.add(path)
+
+
+def _resume_offset(sftp, src, part, fsize):
+    """Return the offset to resume upload from partial file, or 0
+
+    The last `RESUME_WINDOW` bytes of the partial file are compared with
+    the local file, in case the local file has been changed since.
+
+    """
+    try:
+        size = sftp.stat(part).st_size
+    except IOError:
+        return 0
+
+    if not size or size > fsize:
+        return 0
+
+    window = min(RESUME_WINDOW, size)
+    try:
+        with sftp.open(part, "rb") as remote, open(src, "rb") as local:
+            remote.seek(size - window)
+            local.seek(size - window)
+            if remote.read(window) != local.read(window):
+                return 0
+    except IOError:
+        return 0
+
+    return size
+
+
+def _complete(sftp, src, part, dst, fsize):
+    """Verify partial file, preserve mtime and rename it to destination"""
+    stat = sftp.stat(part)
+    if stat.st_size != fsize:
+        raise IOError("Size mismatch in upload! %d != %d"
+                      % (stat.st_size, fsize))
+
+    local_stat = os.stat(src)
+    sftp.utime(part, (local_stat.st_atime, local_stat.st_mtime))
+
+    try:
+        # Atomic overwrite, OpenSSH extension
+        sftp.posix_rename(part, dst)
+    except IOError:
+        _rename(sftp, part, dst)
+
+
+def _rename(sftp, part, dst):
+    """Rename partial file to destination, without atomic overwrite"""
+    try:
+        sftp.remove(dst)
+    except IOError:
+        pass
+    sftp.rename(part, dst)
+
+
+def _stat_batch(paths):
+    """Return file sizes of a batch of paths"""
+    sizes = dict()
+
+    if os.name == "nt":
+        # Directory listing carries file stat on Windows, so list each dir
+        # once instead of one round trip per file on network drives.
+        by_dir = dict()
+        for path in paths:
+            dirname, name = os.path.split(path)
+            by_dir.setdefault(dirname, dict())[name.lower()] = path
+
+        for dirname, names in by_dir.items():
+            try:
+                entries = list(os.scandir(dirname or "."))
+            except OSError:
+                continue
+            for entry in entries:
+                path = names.get(entry.name.lower())
+                if path is not None and entry.is_file():
+                    sizes[path] = entry.stat().st_size
+
+    for path in paths:
+        if path not in sizes:
+            sizes[path] = os.path.getsize(path)
+
+    return sizes
 
 
 class PackageProducer(object):
 
+    STAT_THREADS = 16
+    STAT_BATCH = 64
+
     def __init__(self):
         self.producing = False
         self.interrupted = False
@@ -162,15 +1140,20 @@ class PackageProducer(object):
             self.interrupted = False
             self.producing = True
 
-            for package in self._digest(resource):
-                if not self.interrupted:
-                    on_produce(package)
-                else:
-                    break
+            try:
+                for package in self._digest(resource):
+                    if not self.interrupted:
+                        on_produce(package)
+                    else:
+                        break
 
-            # Bye
-            self.producing = False
-            on_complete()
+            except Exception as error:
+                main_logger.error("Staging failed: %s" % error)
+
+            finally:
+                # Bye
+                self.producing = False
+                on_complete()
 
         producer = threading.Thread(target=produce, daemon=True)
         producer.start()
@@ -178,62 +1161,89 @@ class PackageProducer(object):
     def _digest(self, resource):
         packages = self._parse(resource)
 
-        for data in packages:
-            # A list of (local, remote) file path tuple
-            # Ensure unique and sort for hashing
-            files = sorted(set([(src, dst) for src, dst in data["files"]]))
+        with ThreadPoolExecutor(max_workers=self.STAT_THREADS) as executor:
+            for data in packages:
+                yield self._package(data, executor)
+
+    def _package(self, data, executor):
+        # A list of (local, remote) file path tuple
+        # Ensure unique and sort for hashing
+        files = sorted(set([(src, dst) for src, dst in data["files"]]))
+
+        # Summing file size
+        sizes = self._stat(sorted(set(src for src, dst in files)), executor)
+
+        contents = list()
+        total_size = 0
+        hash_obj = hashlib.sha512()  # For preventing duplicate package
 
-            contents = list()
-            total_size = 0
-            hash_obj = hashlib.sha512()  # For preventing duplicate package
+        for src, dst in files:
+            hash_obj.update(src.encode())
+            hash_obj.update(dst.encode())
 
-            for src, dst in files:
-                hash_obj.update(src.encode())
-                hash_obj.update(dst.encode())
+            fsize = sizes[src]
+            total_size += fsize
 
-                # Summing file size
-                fsize = os.path.getsize(src)
-                total_size += fsize
+            contents.append((src, dst, fsize))
 
-                contents.append((src, dst, fsize))
+        if total_size == 0:
+            main_logger.error("Package size is 0, this should not happen.")
 
-            if total_size == 0:
-                main_logger.error("Package size is 0, this should not happen.")
+        package = {
+            "project": data["project"],
+            "type": data["type"],
+            "description": data["description"],
+            "site": data["site"],
+            "files": contents,
+            "status": 0,
+            "count": len(files),
+            "size": round(total_size / float(1024**2), 2),  # (MB)
 
-            package = {
-                "project": data["project"],
-                "type": data["type"],
-                "description": data["description"],
-                "site": data["site"],
-                "files": contents,
-                "status": 0,
-                "count": len(files),
-                "size": round(total_size / float(1024**2), 2),  # (MB)
+            "byte": total_size,
+            "hash": data["site"] + str(hash_obj.digest()),
+        }
 
-                "byte": total_size,
-                "hash": data["site"] + str(hash_obj.digest()),
-            }
+        return package
 
-            yield package
+    def _stat(self, paths, executor):
+        """Return a dict of file sizes, stat'ed concurrently in batches
+
+        Args:
+            paths (list): Sorted local file paths
+            executor (ThreadPoolExecutor): Thread pool for stat calls
+
+        """
+        if os.name == "nt":
+            # One batch per dir, see `_stat_batch`
+            by_dir = dict()
+            for path in paths:
+                by_dir.setdefault(os.path.dirname(path), list()).append(path)
+            batches = list(by_dir.values())
+        else:
+            batches = [paths[i:i + self.STAT_BATCH]
+                       for i in range(0, len(paths), self.STAT_BATCH)]
+
+        sizes = dict()
+        for batch_sizes in executor.map(_stat_batch, batches):
+            sizes.update(batch_sizes)
+
+        return sizes
 
     def _parse(self, json_file):
         if not json_file:
             main_logger.warning("Please input package file path.")
-            return []
+            return
 
         if not os.path.isfile(json_file):
             main_logger.error("File not exists.")
-            return []
+            return
 
+        # Packages are yielded while the file is still being parsed
         try:
-            with open(json_file, "r") as file:
-                packages = json.load(file)
-        except Exception:
-            main_logger.error("JSON parsing error.")
-            return []
+            for package in jobfile.read(json_file):
+                yield package
 
-        if not isinstance(packages, list):
+        except jobfile.NotAListError:
             main_logger.error("Should be a `list` of upload packages.")
-            return []
-
-        return packages
+        except Exception:
+            main_logger.error("JSON parsing error.")
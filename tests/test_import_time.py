@@ -0,0 +1,95 @@
+
+"""Import of the package, `util` and the headless path must stay light
+
+Run with `python -m unittest discover tests` or `python -m pytest tests`.
+
+"""
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ("avalon_sftpc", "avalon_sftpc.util", "avalon_sftpc.headless")
+
+# Cumulative import time of `MODULES`, about 50ms on a laptop
+BUDGET = 0.15
+
+# Modules which must only be imported when used
+HEAVY = (
+    "avalon",
+    "Qt",
+    "PySide",
+    "PySide2",
+    "PyQt4",
+    "PyQt5",
+    "qtawesome",
+    "paramiko",
+    "pysftp",
+    "asyncssh",
+    "sqlite3",
+    "_sqlite3",
+)
+
+
+def import_fresh():
+    """Import `MODULES` in a new interpreter
+
+    Returns:
+        tuple: Names of loaded modules, and `-X importtime` report lines
+
+    """
+    code = ("import sys, json; import %s; "
+            "print(json.dumps(sorted(sys.modules)))" % ", ".join(MODULES))
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code],
+                               cwd=ROOT,
+                               env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("Import failed:\n%s" % stderr)
+
+    return json.loads(stdout), stderr.splitlines()
+
+
+def cumulative(report, name):
+    """Return cumulative import time of module `name` in seconds, or 0"""
+    for line in report:
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        _, cost, module = line.split("|")
+        if module.strip() == name and not module[1:].startswith(" "):
+            return int(cost) / 1e6
+    return 0
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_no_heavy_modules(self):
+        modules, _ = import_fresh()
+        loaded = [name for name in modules if name.split(".")[0] in HEAVY]
+        self.assertEqual(loaded, [])
+
+    def test_budget(self):
+        # Best of a few, a cold disk cache is not what this guards against
+        elapsed = list()
+        for _ in range(3):
+            _, report = import_fresh()
+            elapsed.append(sum(cumulative(report, name) for name in MODULES))
+
+        self.assertLess(min(elapsed), BUDGET,
+                        "Importing %s took %.0fms, budget is %.0fms"
+                        % (", ".join(MODULES),
+                           min(elapsed) * 1000,
+                           BUDGET * 1000))
+
+
+if __name__ == "__main__":
+    unittest.main()